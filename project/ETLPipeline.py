@@ -1,78 +1,894 @@
 import pandas as pd
 import numpy as np
 import os
+import abc
+import sys
 import requests
 import zipfile
 import shutil
-import sqlite3
+import tempfile
+import hashlib
+import json
+import time
+import threading
+import functools
+import itertools
+import contextlib
+import contextvars
+import logging
+import uuid
+import sqlalchemy
+from sqlalchemy.pool import QueuePool, NullPool
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from pandas.api.indexers import BaseIndexer
 from tqdm import tqdm
 
+# Optional dependency of the Parquet and Arrow storage backends
+try:
+    import pyarrow
+    import pyarrow.feather
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+# Serializes the writes of concurrent stages to the SQLite database
+database_write_lock = threading.RLock()
+
+# Structured log of the pipeline stages, one JSON object per finished stage
+logger = logging.getLogger(__name__)
+
+
+class TableStorage(abc.ABC):
+    # Stores every table as a file in a directory, the columnar alternative to SQLite
+    # for the intermediate tables. Subclasses define the file format.
+    extension = ''
+
+    def __init__(self, directory: str):
+        if pyarrow is None:
+            raise ValueError("The pyarrow package is required for the Parquet and Arrow storage.")
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, name + self.extension)
+
+    def exists(self, name: str) -> bool:
+        return os.path.exists(self.path(name))
+
+    def write(self, name: str, data: pd.DataFrame, if_exists: str = 'replace') -> None:
+        if self.exists(name):
+            if if_exists == 'fail':
+                raise ValueError(f"Table '{name}' already exists.")
+            if if_exists == 'append':
+                data = pd.concat([self.read(name), data], ignore_index=True)
+
+        # Write to a temporary file first, so readers never see a partial table
+        table = pyarrow.Table.from_pandas(data, preserve_index=False)
+        tmp_path = self.path(name) + '.tmp'
+        self.write_table(table, tmp_path)
+        os.replace(tmp_path, self.path(name))
+
+    def read(self, name: str, columns: list = None) -> pd.DataFrame:
+        if not self.exists(name):
+            raise ValueError("Table not found in database.")
+        return self.read_table(self.path(name), columns).to_pandas()
+
+    def read_chunks(self, name: str, chunksize: int = 100000, columns: list = None):
+        # Record batches of at most chunksize rows, the table is never read at once
+        if not self.exists(name):
+            raise ValueError("Table not found in database.")
+        for batch in self.read_batches(self.path(name), chunksize, columns):
+            yield batch.to_pandas()
+
+    def write_chunks(self, name: str, chunks, column_types: dict = None) -> int:
+        # Stream the chunks into one file with the schema of the column types or of the
+        # first chunk, later chunks are cast to it. Only one chunk is held in memory.
+        rows = 0
+        writer = None
+        tmp_path = self.path(name) + '.tmp'
+        try:
+            for chunk in chunks:
+                if writer is None:
+                    schema = arrow_schema(column_types or declared_column_types(name, chunk))
+                    writer = self.open_writer(tmp_path, schema)
+                writer.write_table(pyarrow.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+                rows += len(chunk)
+            if writer is None and column_types is not None:
+                writer = self.open_writer(tmp_path, arrow_schema(column_types))
+        except:
+            if writer is not None:
+                writer.close()
+                os.remove(tmp_path)
+            raise
+        if writer is not None:
+            writer.close()
+            os.replace(tmp_path, self.path(name))
+        return rows
+
+    def column_types(self, name: str) -> dict:
+        # SQL type of every column, mapped from the file schema like the dtypes of to_sql
+        if not self.exists(name):
+            raise ValueError("Table not found in database.")
+        data = self.read_schema(self.path(name)).empty_table().to_pandas()
+        return {column: sql_column_type(data[column]) for column in data.columns}
+
+    @abc.abstractmethod
+    def write_table(self, table: 'pyarrow.Table', path: str) -> None:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def read_table(self, path: str, columns: list = None) -> 'pyarrow.Table':
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def read_batches(self, path: str, chunksize: int, columns: list = None):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def read_schema(self, path: str) -> 'pyarrow.Schema':
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def open_writer(self, path: str, schema: 'pyarrow.Schema'):
+        raise NotImplementedError
+
+
+class ParquetStorage(TableStorage):
+    extension = '.parquet'
+
+    def write_table(self, table: 'pyarrow.Table', path: str) -> None:
+        pyarrow.parquet.write_table(table, path)
+
+    def read_table(self, path: str, columns: list = None) -> 'pyarrow.Table':
+        return pyarrow.parquet.read_table(path, columns=columns)
+
+    def read_batches(self, path: str, chunksize: int, columns: list = None):
+        return pyarrow.parquet.ParquetFile(path).iter_batches(batch_size=chunksize, columns=columns)
+
+    def read_schema(self, path: str) -> 'pyarrow.Schema':
+        return pyarrow.parquet.read_schema(path)
+
+    def open_writer(self, path: str, schema: 'pyarrow.Schema'):
+        # Every written chunk becomes a row group
+        return pyarrow.parquet.ParquetWriter(path, schema)
+
+
+class ArrowStorage(TableStorage):
+    # Uncompressed Arrow IPC files, which are memory-mapped on read instead of decoded
+    extension = '.arrow'
+
+    def write_table(self, table: 'pyarrow.Table', path: str) -> None:
+        pyarrow.feather.write_feather(table, path, compression='uncompressed')
+
+    def read_table(self, path: str, columns: list = None) -> 'pyarrow.Table':
+        return pyarrow.feather.read_table(path, columns=columns, memory_map=True)
+
+    def read_batches(self, path: str, chunksize: int, columns: list = None):
+        # The memory-mapped table is only sliced, a batch is decoded when it is converted
+        return self.read_table(path, columns).to_batches(max_chunksize=chunksize)
+
+    def read_schema(self, path: str) -> 'pyarrow.Schema':
+        with pyarrow.memory_map(path) as source:
+            return pyarrow.ipc.open_file(source).schema
+
+    def open_writer(self, path: str, schema: 'pyarrow.Schema'):
+        # Every written chunk becomes a record batch
+        return pyarrow.ipc.new_file(path, schema)
+
+
+def arrow_schema(column_types: dict) -> 'pyarrow.Schema':
+    # Arrow types of the declared SQL column types
+    types = {'BOOLEAN': pyarrow.bool_(), 'SMALLINT': pyarrow.int16(), 'INTEGER': pyarrow.int32(), 'BIGINT': pyarrow.int64(),
+             'FLOAT': pyarrow.float64(), 'REAL': pyarrow.float64(), 'TIMESTAMP': pyarrow.timestamp('ns')}
+    return pyarrow.schema([(column, types.get(column_type, pyarrow.string())) for column, column_type in column_types.items()])
+
+
+# Storage backends of the intermediate tables, None stores them in the SQLite database
+STORAGE_BACKENDS = {'sqlite': None, 'parquet': ParquetStorage, 'arrow': ArrowStorage}
+
+
+class PipelineContext:
+    # Owns one pooled engine per database location, shared by all stages of a run,
+    # the storage backend of the intermediate tables ('sqlite', 'parquet' or 'arrow') and
+    # whether crash tables are held in memory with the lean dtypes of CRASH_DTYPES.
+    # Used as a context manager it becomes the active context of the pipeline helpers.
+    def __init__(self, pool_size: int = 5, max_overflow: int = 10, pooled: bool = True, storage: str = 'sqlite', lean_dtypes: bool = False):
+        if storage not in STORAGE_BACKENDS:
+            raise ValueError(f"Storage must be one of {', '.join(STORAGE_BACKENDS)}.")
+        self.pooled = pooled
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.storage = storage
+        self.lean_dtypes = lean_dtypes
+        # Tables whose lean dtypes have been reported, once per table and not per chunk
+        self.lean_dtype_reports = set()
+        self.storages = {}
+        self.engines = {}
+        self.connections_opened = 0
+        self.lock = threading.Lock()
+        self.previous = None
+
+    def engine(self, location: str) -> sqlalchemy.engine.Engine:
+        # Plain file paths are treated as SQLite databases
+        if '://' not in location:
+            location = 'sqlite:///' + location
+        with self.lock:
+            if location not in self.engines:
+                # SQLAlchemy does not pool file based SQLite connections by default
+                if self.pooled:
+                    pool_arguments = {'poolclass': QueuePool, 'pool_size': self.pool_size, 'max_overflow': self.max_overflow}
+                else:
+                    pool_arguments = {'poolclass': NullPool}
+                engine = sqlalchemy.create_engine(location,
+                                                  connect_args={'check_same_thread': False, 'timeout': 30},
+                                                  **pool_arguments)
+                sqlalchemy.event.listen(engine, 'connect', self.count_connection)
+                self.engines[location] = engine
+            return self.engines[location]
+
+    def storage_for(self, name: str, location: str) -> 'TableStorage':
+        # Backend of an intermediate table, None if it is stored in the SQLite database.
+        # The raw extracted tables and the bookkeeping of the pipeline always stay in SQLite.
+        if STORAGE_BACKENDS[self.storage] is None or is_raw_table(name) or name.startswith('pipeline_'):
+            return None
+        with self.lock:
+            if location not in self.storages:
+                # The tables are stored in a directory next to the database file
+                directory = os.path.splitext(location.replace('sqlite:///', ''))[0] + '_' + self.storage
+                self.storages[location] = STORAGE_BACKENDS[self.storage](directory)
+            return self.storages[location]
+
+    def count_connection(self, dbapi_connection, connection_record) -> None:
+        with self.lock:
+            self.connections_opened += 1
+
+    def dispose(self) -> None:
+        with self.lock:
+            for engine in self.engines.values():
+                engine.dispose()
+            self.engines = {}
+
+    def __enter__(self) -> 'PipelineContext':
+        global pipeline_context
+        self.previous = pipeline_context
+        pipeline_context = self
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        global pipeline_context
+        pipeline_context = self.previous
+        self.dispose()
+
+
+# Context of the helpers that are called outside of an active PipelineContext. It
+# does not keep connections open, so database files can be replaced between calls.
+pipeline_context = PipelineContext(pooled=False)
+
+
+def run_context(storage: str = None, lean_dtypes: bool = None) -> contextlib.AbstractContextManager:
+    # The active context, or a new pooled one for the duration of a single run
+    if pipeline_context.pooled and storage in (None, pipeline_context.storage) and lean_dtypes in (None, pipeline_context.lean_dtypes):
+        return contextlib.nullcontext(pipeline_context)
+    return PipelineContext(storage=storage or pipeline_context.storage,
+                           lean_dtypes=pipeline_context.lean_dtypes if lean_dtypes is None else lean_dtypes)
+
+
+def get_engine(location: str = 'sqlite:///data/data.sqlite') -> sqlalchemy.engine.Engine:
+    return pipeline_context.engine(location)
+
+
+@contextlib.contextmanager
+def database_connection(location: str = 'sqlite:///data/data.sqlite'):
+    # Borrow a sqlite3 connection from the pool of the active context
+    conn = get_engine(location).raw_connection()
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+# Metrics of the stages that enclose the running code, innermost last. Thread pools of
+# the pipeline copy the context, so nested stages in worker threads count into their parents.
+active_stage_metrics = contextvars.ContextVar('active_stage_metrics', default=())
+
+
+def current_rss() -> int:
+    # Resident set size of the process in bytes, the peak so far where /proc is missing
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+class MemorySampler:
+    # Samples the resident set size in a background thread while stages run and keeps
+    # the peak of every running stage. The thread stops once no stage is running.
+    def __init__(self, interval: float = 0.02):
+        self.interval = interval
+        self.stages = set()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def add(self, metrics: 'StageMetrics') -> None:
+        with self.lock:
+            self.stages.add(metrics)
+            self.sample()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def remove(self, metrics: 'StageMetrics') -> None:
+        with self.lock:
+            self.sample()
+            self.stages.discard(metrics)
+
+    def sample(self) -> None:
+        rss = current_rss()
+        if rss is not None:
+            for metrics in self.stages:
+                metrics.peak_memory_bytes = max(metrics.peak_memory_bytes or 0, rss)
+
+    def run(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                if not self.stages:
+                    self.thread = None
+                    return
+                self.sample()
+
+
+memory_sampler = MemorySampler()
+
+
+class StageMetrics:
+    # Wall time, CPU time, peak memory, rows and bytes of one stage, measured as context
+    # manager around the stage. A stage inherits the run id of its enclosing stage, the
+    # reads and writes of record_read and record_written count into every enclosing stage.
+    # On exit the metrics are logged and, with a location, appended to pipeline_runs.
+    def __init__(self, stage: str, location: str = None, cpu_clock=time.process_time):
+        self.stage = stage
+        self.location = location
+        self.cpu_clock = cpu_clock
+        self.run_id = None
+        self.parent = None
+        self.status = 'ok'
+        self.started_at = None
+        self.wall_seconds = None
+        self.cpu_seconds = None
+        self.peak_memory_bytes = None
+        self.rows_in = 0
+        self.rows_out = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.lock = threading.Lock()
+
+    def __enter__(self) -> 'StageMetrics':
+        enclosing = active_stage_metrics.get()
+        if enclosing:
+            self.run_id = enclosing[-1].run_id
+            self.parent = enclosing[-1].stage
+        else:
+            self.run_id = uuid.uuid4().hex
+        self.token = active_stage_metrics.set(enclosing + (self,))
+        memory_sampler.add(self)
+        self.started_at = time.time()
+        self.start_wall = time.perf_counter()
+        self.start_cpu = self.cpu_clock()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.wall_seconds = time.perf_counter() - self.start_wall
+        self.cpu_seconds = self.cpu_clock() - self.start_cpu
+        memory_sampler.remove(self)
+        active_stage_metrics.reset(self.token)
+        if exc_type is not None:
+            self.status = 'failed'
+        record = self.as_record()
+        logger.info(json.dumps(record))
+        if self.location is not None:
+            store_pipeline_run(record, self.location)
+
+    def add(self, rows_in: int = 0, rows_out: int = 0, bytes_read: int = 0, bytes_written: int = 0) -> None:
+        with self.lock:
+            self.rows_in += rows_in
+            self.rows_out += rows_out
+            self.bytes_read += bytes_read
+            self.bytes_written += bytes_written
+
+    def as_record(self) -> dict:
+        return {'run_id': self.run_id, 'stage': self.stage, 'parent': self.parent, 'status': self.status,
+                'started_at': self.started_at, 'wall_seconds': self.wall_seconds, 'cpu_seconds': self.cpu_seconds,
+                'peak_memory_bytes': self.peak_memory_bytes, 'rows_in': self.rows_in, 'rows_out': self.rows_out,
+                'bytes_read': self.bytes_read, 'bytes_written': self.bytes_written}
+
+
+def record_read(data: pd.DataFrame) -> None:
+    # Count rows and in-memory bytes of a frame read by the running stages
+    for metrics in active_stage_metrics.get():
+        metrics.add(rows_in=len(data), bytes_read=int(data.memory_usage(index=False).sum()))
+
+
+def record_written(data: pd.DataFrame) -> None:
+    # Count rows and in-memory bytes of a frame written by the running stages
+    for metrics in active_stage_metrics.get():
+        metrics.add(rows_out=len(data), bytes_written=int(data.memory_usage(index=False).sum()))
+
+
+def store_pipeline_run(record: dict, location: str = 'sqlite:///data/data.sqlite') -> None:
+    with database_write_lock, database_connection(location) as conn:
+        try:
+            conn.execute('CREATE TABLE IF NOT EXISTS pipeline_runs '
+                         '(run_id TEXT, stage TEXT, parent TEXT, status TEXT, started_at FLOAT, wall_seconds FLOAT, '
+                         'cpu_seconds FLOAT, peak_memory_bytes BIGINT, rows_in BIGINT, rows_out BIGINT, '
+                         'bytes_read BIGINT, bytes_written BIGINT)')
+            conn.execute(f'INSERT INTO pipeline_runs VALUES ({", ".join("?" * len(record))})', tuple(record.values()))
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+
+
+def pipeline_run_report(run_id: str = None, location: str = 'sqlite:///data/data.sqlite') -> pd.DataFrame:
+    # Metrics of every stage of a run, the latest run by default
+    with database_connection(location) as conn:
+        if run_id is None:
+            latest = conn.execute('SELECT run_id FROM pipeline_runs ORDER BY started_at DESC LIMIT 1').fetchone()
+            run_id = latest[0] if latest else None
+        cursor = conn.execute('SELECT * FROM pipeline_runs WHERE run_id = ? ORDER BY started_at', (run_id,))
+        rows = cursor.fetchall()
+    return pd.DataFrame(rows, columns=[column[0] for column in cursor.description])
+
     
-def extract(url: str, testing: bool = False) -> pd.DataFrame:
+def extract(url: str, testing: bool = False, cache: 'DownloadCache' = None) -> pd.DataFrame:
     # check if url is csv or zip
     if url.endswith('.csv'):
-        df = pd.read_csv(url, sep=';')
+        df = pd.read_csv(cache.fetch(url) if cache is not None else url, sep=';', skiprows=sample_rows(testing))
     elif url.endswith('.zip'):
-        df = handle_crash_zip(url)
+        df = handle_crash_zip(url, cache, testing)
     else:
         raise ValueError("URL must be a .csv or .zip file.")
 
-    if testing:
-        df = df.sample(frac=.05)
-
     return df
 
 
-def transform(location: str = 'sqlite:///data/data.sqlite') -> None:
-    if not table_exists("weatherDataID", location):
+def sample_rows(testing: bool = False, frac: float = .05, seed: int = 0):
+    # skiprows of read_csv that keeps the header and a random fraction of the rows. The
+    # sample of a test run is drawn while parsing, the skipped rows never become a frame,
+    # and the seed keeps the test databases reproducible.
+    if not testing:
+        return None
+    rng = np.random.default_rng(seed)
+    return lambda row: row > 0 and rng.random() >= frac
+
+
+def transform(location: str = 'sqlite:///data/data.sqlite',
+              fused: bool = True,
+              workers: int = 0,
+              max_workers: int = 4,
+              pushdown: bool = True,
+              single_pass: bool = True,
+              materialize_filtered: bool = True,
+              storage: str = None,
+              lean_dtypes: bool = None,
+              years: list = None,
+              chunksize: int = None) -> list:
+    # With a chunksize the crash stages run out of core: every stage from the crash years
+    # to crashData and the filtered tables streams chunks, only the weather data is held
+    years = list(years) if years is not None else [2017, 2018, 2019]
+    threshold_distance = 600
+
+    # Join results of the per-year nodes, reused by the crashData node in fused mode
+    join_results = {}
+    pool = CrashYearPool(workers, threshold_distance, location, pushdown) if workers > 0 and chunksize is None else None
+
+    def run_weather_data() -> None:
         load("weatherDataID", preprocess_weather_data(location), location)
-    years = [2017, 2018, 2019]
-    for _, year in tqdm(enumerate(years), total=len(years), desc="Preproccesing Years"):
-        if not table_exists("crashDataNearby" + str(year), location):
-            crashData = preprocess_crash_data("crashData" + str(year), year, location)
-            crashData = connect_crash_data_with_weather_data("crashData" + str(year), crashData, 600, location)
-            load("crashDataNearby" + str(year), crashData , location)
-
-    if not table_exists("crashData", location):
-        load("crashData", assign_crash_to_weather_data(0, 600, location), location)
-
-    if not table_exists("crashDataWet", location):
-        load("crashDataWet", filter_wet_snow_crash_data(1, location), location)
-    
-    if not table_exists("crashDataSnow", location):
-        load("crashDataSnow", filter_wet_snow_crash_data(2, location), location)
-    
-    if not table_exists("crashDataWetSnow", location):
-        load("crashDataWetSnow", filter_wet_snow_crash_data(3, location), location)
 
-    if not table_exists("weatherCrashData", location):
-        weatherCrashData = combine_weather_and_crash_data(location)
+    def run_crash_year(year: int) -> None:
+        if chunksize is not None:
+            weatherData = read_table_from_sqlite('weatherDataID', location)
+            load_chunks("crashDataNearby" + str(year), join_crash_year_chunks(year, weatherData, threshold_distance, location, chunksize), location, bulk=True)
+            return
+        if pool is not None:
+            # Preprocess the year in a worker process, the main process writes the results
+            crashData, join = pool.submit(year, fused).result()
+        elif fused:
+            # Filter the crashes and keep the join result for the Strecke assignment
+            crashData, join = join_crash_year(year, read_table_from_sqlite('weatherDataID', location), threshold_distance, location, pushdown)
+        else:
+            crashData = preprocess_crash_data("crashData" + str(year), year, location, pushdown)
+            crashData = connect_crash_data_with_weather_data("crashData" + str(year), crashData, threshold_distance, location)
+            join = None
+        if join is not None:
+            join_results[year] = join.reset_index(drop=True)
+        load("crashDataNearby" + str(year), crashData, location)
+
+    def run_crash_data() -> None:
+        if chunksize is not None:
+            column_types = concat_column_types(nearby_tables, location)
+            column_types.update({'Strecke': 'TEXT', 'StreckeID': 'TEXT'})
+            load_chunks("crashData", assign_crash_data_chunks(years, threshold_distance, location, chunksize), location, column_types, bulk=True)
+            return
+        if fused:
+            crashData = assign_crash_data_from_joins(years, join_results, threshold_distance, location)
+        else:
+            crashData = assign_crash_to_weather_data(0, threshold_distance, location, years=years)
+        load("crashData", crashData, location)
+
+    def run_filter(name: str, filter: int) -> None:
+        if chunksize is not None:
+            chunks = filter_wet_snow_crash_data(filter, location, chunksize)
+            load_chunks(name, chunks, location, table_column_types("crashData", location), bulk=True)
+            return
+        load(name, filter_wet_snow_crash_data(filter, location), location)
+
+    def run_crash_counts() -> None:
+        load("crashCounts", crash_counts_per_year(location, chunksize), location)
+
+    def run_weather_crash_data() -> None:
+        weatherCrashData = combine_weather_and_crash_data(location, single_pass, chunksize)
         weatherCrashData = add_column_with_normalized_crash_values(weatherCrashData)
         load("weatherCrashData", weatherCrashData, location)
 
-    if not table_exists("weatherCrashDataNormalized", location):
+    def run_normalized() -> None:
         load("weatherCrashDataNormalized", normalize_per_Route(location), location)
 
-        
-def load(name: str, data: pd.DataFrame, location: str = 'sqlite:///data/data.sqlite') -> None:
-    data.to_sql(name, location, if_exists='replace', index=False)
-
-
-def handle_crash_zip(zip_url:str) -> pd.DataFrame:
-    # Create the 'tmp' folder if it doesn't exist
-    if not os.path.exists('tmp'):
-        os.makedirs('tmp')
+    def run_levels_of_detail() -> None:
+        load("weatherCrashDataLOD", aggregate_levels_of_detail(location), location)
+
+    nearby_tables = ["crashDataNearby" + str(year) for year in years]
+    parameters = f"threshold_distance={threshold_distance}"
+    nodes = [PipelineNode("weatherDataID", ["weatherData"], ["weatherDataID"], run_weather_data)]
+    for year in years:
+        nodes.append(PipelineNode("crashDataNearby" + str(year), ["weatherDataID", "crashData" + str(year)], ["crashDataNearby" + str(year)],
+                                  functools.partial(run_crash_year, year), parameters))
+    filtered_tables = ["crashDataWet", "crashDataSnow", "crashDataWetSnow"]
+    nodes.append(PipelineNode("crashData", ["weatherDataID"] + nearby_tables, ["crashData"], run_crash_data, parameters))
+    # The single pass counts the categories from crashData, the filtered tables are only kept on request
+    if materialize_filtered or not single_pass:
+        for filter, table in enumerate(filtered_tables, start=1):
+            nodes.append(PipelineNode(table, ["crashData"], [table], functools.partial(run_filter, table, filter)))
+    weather_crash_inputs = ["weatherDataID", "crashData"] + ([] if single_pass else filtered_tables)
+    nodes += [
+        PipelineNode("crashCounts", ["crashData"], ["crashCounts"], run_crash_counts),
+        PipelineNode("weatherCrashData", weather_crash_inputs, ["weatherCrashData"], run_weather_crash_data),
+        PipelineNode("weatherCrashDataNormalized", ["weatherCrashData"], ["weatherCrashDataNormalized"], run_normalized),
+        PipelineNode("weatherCrashDataLOD", ["weatherCrashDataNormalized"], ["weatherCrashDataLOD"], run_levels_of_detail,
+                     f"bucket_sizes={LOD_BUCKET_SIZES}")
+    ]
 
-    # Download the zip file
-    response = requests.get(zip_url)
-    zip_file_path = os.path.join('tmp', 'data.zip')
+    try:
+        with run_context(storage, lean_dtypes), StageMetrics('transform', location):
+            if chunksize is not None:
+                enable_wal(location)
+            return run_pipeline(nodes, location, max_workers)
+    finally:
+        if pool is not None:
+            pool.close()
+
+
+class PipelineNode:
+    # A stage of the pipeline that reads its input tables and writes its output tables
+    def __init__(self, name: str, inputs: list, outputs: list, run, parameters: str = ''):
+        self.name = name
+        self.inputs = inputs
+        self.outputs = outputs
+        self.run = run
+        self.parameters = parameters
+
+
+def run_pipeline(nodes: list, location: str = 'sqlite:///data/data.sqlite', max_workers: int = 4) -> list:
+    # Run the nodes whose outputs are missing or whose input fingerprints changed since
+    # their last run, together with all of their descendants. Independent nodes run
+    # concurrently. Returns the names of the nodes that ran.
+    producers = {output: node.name for node in nodes for output in node.outputs}
+    dependencies = {node.name: {producers[table] for table in node.inputs if table in producers} for node in nodes}
+    stored_fingerprints = read_node_fingerprints(location)
+    table_fingerprints = {}
+    ran = []
+
+    def fingerprint(table: str) -> tuple:
+        if table not in table_fingerprints:
+            table_fingerprints[table] = table_fingerprint(table, location)
+        return table_fingerprints[table]
+
+    def run_node(node: PipelineNode, force: bool) -> bool:
+        # Every node runs in its own thread, so its CPU time is the time of that thread
+        with StageMetrics(node.name, location, time.thread_time) as metrics:
+            fingerprints = {table: fingerprint(table) for table in node.inputs}
+            up_to_date = (not force
+                          and all(table_exists(table, location) for table in node.outputs)
+                          and stored_fingerprints.get(node.name) == (node.parameters, fingerprints))
+            if up_to_date:
+                metrics.status = 'skipped'
+                return False
+            node.run()
+            for table in node.outputs:
+                table_fingerprints.pop(table, None)
+            store_node_fingerprints(node.name, node.parameters, fingerprints, location)
+            return True
+
+    done = set()
+    running = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor, tqdm(total=len(nodes), desc="Transforming") as progress:
+        while len(done) < len(nodes):
+            # Start every node whose dependencies are finished
+            for node in nodes:
+                if node.name not in done and node not in running.values() and dependencies[node.name] <= done:
+                    force = any(dependency in ran for dependency in dependencies[node.name])
+                    running[executor.submit(contextvars.copy_context().run, run_node, node, force)] = node
+            if not running:
+                raise ValueError("Pipeline nodes contain a cycle.")
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                node = running.pop(future)
+                if future.result():
+                    ran.append(node.name)
+                done.add(node.name)
+                progress.update(1)
+
+    return ran
+
+
+def table_fingerprint(name: str, location: str = 'sqlite:///data/data.sqlite') -> tuple:
+    # Row count, schema hash and content hash of a table, None if the table does not exist
+    if not table_exists(name, location):
+        return None
+    storage = pipeline_context.storage_for(name, location)
+    if storage is not None:
+        # Hash the record batches of the file, so large tables never have to fit in memory
+        rows = 0
+        content_hash = hashlib.sha256()
+        for chunk in storage.read_chunks(name):
+            rows += len(chunk)
+            content_hash.update(pd.util.hash_pandas_object(chunk, index=False).to_numpy().tobytes())
+        schema = list(storage.column_types(name).items())
+        return rows, hashlib.sha256(repr(schema).encode()).hexdigest(), content_hash.hexdigest()
+
+    with database_connection(location) as conn:
+        rows = conn.execute(f'SELECT COUNT(*) FROM "{name}"').fetchone()[0]
+        schema = conn.execute(f'PRAGMA table_info("{name}")').fetchall()
+    schema_hash = hashlib.sha256(repr(schema).encode()).hexdigest()
+
+    # Hash the rows in chunks, so large tables never have to fit in memory
+    content_hash = hashlib.sha256()
+    for chunk in pd.read_sql_query(f'SELECT * FROM "{name}"', get_engine(location), chunksize=100000):
+        content_hash.update(pd.util.hash_pandas_object(chunk, index=False).to_numpy().tobytes())
+    return rows, schema_hash, content_hash.hexdigest()
+
+
+def read_node_fingerprints(location: str = 'sqlite:///data/data.sqlite') -> dict:
+    # Parameters and input fingerprints of every node at its last run
+    if not table_exists('pipeline_fingerprints', location):
+        return {}
+    with database_connection(location) as conn:
+        rows = conn.execute('SELECT node, parameters, input, rows, schema_hash, content_hash FROM pipeline_fingerprints').fetchall()
+
+    fingerprints = {}
+    for node, parameters, table, table_rows, schema_hash, content_hash in rows:
+        fingerprint = None if table_rows is None else (table_rows, schema_hash, content_hash)
+        fingerprints.setdefault(node, (parameters, {}))[1][table] = fingerprint
+    return fingerprints
+
+
+def store_node_fingerprints(node: str, parameters: str, fingerprints: dict, location: str = 'sqlite:///data/data.sqlite') -> None:
+    with database_write_lock, database_connection(location) as conn:
+        try:
+            conn.execute('CREATE TABLE IF NOT EXISTS pipeline_fingerprints '
+                         '(node TEXT, parameters TEXT, input TEXT, rows BIGINT, schema_hash TEXT, content_hash TEXT, updated_at FLOAT)')
+            conn.execute('DELETE FROM pipeline_fingerprints WHERE node = ?', (node,))
+            conn.executemany('INSERT INTO pipeline_fingerprints VALUES (?, ?, ?, ?, ?, ?, ?)',
+                             [(node, parameters, table) + (fingerprint or (None, None, None)) + (time.time(),)
+                              for table, fingerprint in fingerprints.items()])
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+
+
+def invalidate_node_fingerprints(nodes: list, location: str = 'sqlite:///data/data.sqlite') -> None:
+    # Forget the last run of the nodes, so the next transform runs them again
+    if not table_exists('pipeline_fingerprints', location):
+        return
+    with database_write_lock, database_connection(location) as conn:
+        try:
+            conn.executemany('DELETE FROM pipeline_fingerprints WHERE node = ?', [(node,) for node in nodes])
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+
+
+def load(name: str,
+         data: pd.DataFrame,
+         location: str = 'sqlite:///data/data.sqlite',
+         if_exists: str = 'replace',
+         bulk: bool = False,
+         report: bool = True) -> None:
+    # A bulk load reports its rate, unless it is one chunk of a chunked load
+    # Lean dtypes only live in memory, the tables keep their column types
+    if pipeline_context.lean_dtypes:
+        data = restore_dtypes(data)
+    record_written(data)
+    storage = pipeline_context.storage_for(name, location)
+    with database_write_lock:
+        if storage is not None:
+            storage.write(name, data, if_exists)
+        elif bulk:
+            rows_per_second = bulk_load(name, data, location, if_exists)
+            if report:
+                report_load(name, len(data), len(data) / rows_per_second)
+        else:
+            data.to_sql(name, get_engine(location), if_exists=if_exists, index=False)
+
+
+# Declared column types of the raw crash tables, every other column is a BIGINT
+CRASH_COLUMN_TYPES = {'UIDENTSTLA': 'TEXT', 'LINREFX': 'FLOAT', 'LINREFY': 'FLOAT', 'XGCSWGS84': 'FLOAT', 'YGCSWGS84': 'FLOAT'}
+
+
+def declared_column_types(name: str, data: pd.DataFrame) -> dict:
+    # SQL types of the table, the raw tables are declared and all others follow the dtypes like to_sql
+    if name == 'weatherData':
+        return {column: 'TEXT' if column == 'Strecke' else 'FLOAT' for column in data.columns}
+    if is_raw_table(name):
+        return {column: CRASH_COLUMN_TYPES.get(column, 'BIGINT') for column in data.columns}
+    return {column: sql_column_type(data[column]) for column in data.columns}
+
+
+# Lean dtypes of the Unfallatlas columns. The regional keys get categoricals with all
+# values of their key range, so the categories of different tables stay concatenable.
+CRASH_DTYPES = {'OBJECTID': 'int32', 'OBJECTID_1': 'int32',
+                'ULAND': pd.CategoricalDtype(range(1, 17)),
+                'UREGBEZ': pd.CategoricalDtype(range(10)),
+                'UKREIS': pd.CategoricalDtype(range(100)),
+                'UGEMEINDE': 'int16', 'UJAHR': 'int16',
+                'UMONAT': 'int8', 'USTUNDE': 'int8', 'UWOCHENTAG': 'int8', 'UKATEGORIE': 'int8', 'UART': 'int8',
+                'UTYP1': 'int8', 'ULICHTVERH': 'int8', 'LICHT': 'int8', 'STRZUSTAND': 'int8',
+                'IstRad': 'bool', 'IstPKW': 'bool', 'IstFuss': 'bool', 'IstKrad': 'bool', 'IstGkfz': 'bool',
+                'IstSonstig': 'bool', 'IstSonstige': 'bool'}
+
+
+def optimize_dtypes(name: str, data: pd.DataFrame) -> pd.DataFrame:
+    # Convert the integer columns of a crash table to the lean dtypes of CRASH_DTYPES.
+    # A column keeps its dtype if it has values that do not fit the lean dtype.
+    if not name.startswith('crashData'):
+        return data
+    with pipeline_context.lock:
+        report = name not in pipeline_context.lean_dtype_reports
+        pipeline_context.lean_dtype_reports.add(name)
+    before = data.memory_usage(deep=True).sum() if report else 0
+    converted = {}
+    for column, dtype in CRASH_DTYPES.items():
+        # Float columns stay floats, they are written as FLOAT
+        if column not in data or not (pd.api.types.is_integer_dtype(data[column]) or pd.api.types.is_bool_dtype(data[column])):
+            continue
+        values = data[column]
+        if isinstance(dtype, pd.CategoricalDtype):
+            fits = values.isin(dtype.categories).all()
+        elif dtype == 'bool':
+            fits = values.isin([0, 1]).all()
+        else:
+            fits = len(values) == 0 or (values.min() >= np.iinfo(dtype).min and values.max() <= np.iinfo(dtype).max)
+        if fits:
+            converted[column] = values.astype(dtype)
+    # Only the converted columns are new, the others stay shared with the given frame
+    data = data.copy(deep=False)
+    for column, values in converted.items():
+        data[column] = values
+    if report:
+        after = data.memory_usage(deep=True).sum()
+        logger.info(f"Lean dtypes of {name}: {before / 1024 ** 2:.2f} MB -> {after / 1024 ** 2:.2f} MB")
+    return data
+
+
+def restore_dtypes(data: pd.DataFrame) -> pd.DataFrame:
+    # Undo optimize_dtypes before writing, so the written column types do not change.
+    # Concatenated tables turn missing values of lean columns into floats or objects.
+    columns = {}
+    for column in data.columns.intersection(list(CRASH_DTYPES)):
+        values = data[column]
+        if isinstance(values.dtype, pd.CategoricalDtype) or values.dtype == object or values.dtype == bool:
+            columns[column] = values.astype('float64') if values.hasnans else values.astype('int64')
+        elif pd.api.types.is_integer_dtype(values) and values.dtype != 'int64':
+            columns[column] = values.astype('int64')
+    return data.assign(**columns) if columns else data
+
+
+def sql_column_type(column: pd.Series) -> str:
+    # Same mapping as DataFrame.to_sql for SQLite
+    if pd.api.types.is_bool_dtype(column):
+        return 'BOOLEAN'
+    if pd.api.types.is_integer_dtype(column):
+        if column.dtype.itemsize <= 2 and column.dtype.name != 'uint16':
+            return 'SMALLINT'
+        if column.dtype.itemsize <= 4 and column.dtype.name != 'uint32':
+            return 'INTEGER'
+        return 'BIGINT'
+    if pd.api.types.is_float_dtype(column):
+        return 'FLOAT'
+    if pd.api.types.is_datetime64_any_dtype(column):
+        return 'TIMESTAMP'
+    return 'TEXT'
+
+
+def bulk_load(name: str,
+              data: pd.DataFrame,
+              location: str = 'sqlite:///data/data.sqlite',
+              if_exists: str = 'replace',
+              column_types: dict = None,
+              batch_size: int = 50000) -> float:
+    # Faster alternative to DataFrame.to_sql: WAL journal, relaxed synchronous, declared
+    # column types and executemany batches in a single transaction. Returns rows per second.
+    # sqlite3 commits DDL outside of an explicit transaction, so BEGIN comes before the DROP
+    # and a failed load keeps the previous table.
+    start = time.perf_counter()
+    if column_types is None:
+        column_types = declared_column_types(name, data)
+
+    # Timestamps are stored as text like to_sql does
+    for column in data.columns:
+        if pd.api.types.is_datetime64_any_dtype(data[column]):
+            data = data.assign(**{column: data[column].astype(str)})
+
+    table = name.replace('"', '""')
+    columns = ', '.join(f'"{column}" {column_types[column]}' for column in data.columns)
+    placeholders = ', '.join('?' * len(data.columns))
+
+    with database_write_lock, database_connection(location) as conn:
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('BEGIN')
+        try:
+            exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (name,)).fetchone() is not None
+            if exists and if_exists == 'fail':
+                raise ValueError(f"Table '{name}' already exists.")
+            if exists and if_exists == 'replace':
+                conn.execute(f'DROP TABLE "{table}"')
+            if not exists or if_exists == 'replace':
+                conn.execute(f'CREATE TABLE "{table}" ({columns})')
+
+            rows = data.itertuples(index=False, name=None)
+            for batch in iter(lambda: list(itertools.islice(rows, batch_size)), []):
+                conn.executemany(f'INSERT INTO "{table}" VALUES ({placeholders})', batch)
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+
+    return len(data) / max(time.perf_counter() - start, 1e-9)
+
+
+def report_load(name: str, rows: int, seconds: float) -> None:
+    # One line per loaded table, the chunked loads add up their chunks
+    logger.info(f"Loaded {rows} rows into {name} ({rows / max(seconds, 1e-9):.0f} rows/s)")
+
+
+def handle_crash_zip(zip_url:str, cache: 'DownloadCache' = None, testing: bool = False) -> pd.DataFrame:
+    # Create a private 'tmp' folder, so parallel runs do not collide
+    tmp_folder = tempfile.mkdtemp(prefix='tmp')
 
     try:
-        with open(zip_file_path, 'wb') as zip_file:
-            zip_file.write(response.content)
+        # Download the zip file, or take it from the cache
+        if cache is not None:
+            zip_file_path = cache.fetch(zip_url)
+        else:
+            response = requests.get(zip_url)
+            zip_file_path = os.path.join(tmp_folder, 'data.zip')
+            with open(zip_file_path, 'wb') as zip_file:
+                zip_file.write(response.content)
 
         # Extract the zip file
-        extract_folder = os.path.join('tmp', 'extracted')
+        extract_folder = os.path.join(tmp_folder, 'extracted')
         with zipfile.ZipFile(zip_file_path, 'r') as zip_ref:
             zip_ref.extractall(extract_folder)
 
@@ -85,7 +901,7 @@ def handle_crash_zip(zip_url:str) -> pd.DataFrame:
             raise ValueError("No txt files found in the 'csv' folder.")
 
         # Load CSV file into a Pandas DataFrame
-        df = pd.read_csv(first_txt_file, sep=';', low_memory=False, decimal=',')
+        df = pd.read_csv(first_txt_file, sep=';', low_memory=False, decimal=',', skiprows=sample_rows(testing))
 
         # Now you can work with the DataFrame as needed
         return df
@@ -95,14 +911,299 @@ def handle_crash_zip(zip_url:str) -> pd.DataFrame:
 
     finally:
         # Remove the 'tmp' folder
-        shutil.rmtree('tmp')
+        shutil.rmtree(tmp_folder)
+
+
+def download_to_spooled_file(url: str, chunk_size: int = 1024 * 1024, max_memory: int = 64 * 1024 * 1024) -> tempfile.SpooledTemporaryFile:
+    # Download in chunks, the file only moves to disk once it exceeds max_memory
+    spooled_file = tempfile.SpooledTemporaryFile(max_size=max_memory)
+    with requests.get(url, stream=True) as response:
+        response.raise_for_status()
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            spooled_file.write(chunk)
+    spooled_file.seek(0)
+    return spooled_file
+
+
+def find_crash_csv_member(zip_ref: zipfile.ZipFile) -> str:
+    # Find the first txt file in the 'csv' folder of the archive
+    for member in zip_ref.namelist():
+        folder, file_name = os.path.split(member)
+        if os.path.basename(folder) == 'csv' and file_name.endswith('.txt'):
+            return member
+    raise ValueError("No txt files found in the 'csv' folder.")
+
+
+def read_csv_chunks(url: str, chunksize: int = 100000, cache: 'DownloadCache' = None, testing: bool = False):
+    # Yield the rows of a csv or zipped crash csv without extracting it to disk
+    source = open(cache.fetch(url), 'rb') if cache is not None else download_to_spooled_file(url)
+    with source as source_file:
+        if url.endswith('.csv'):
+            yield from pd.read_csv(source_file, sep=';', chunksize=chunksize, skiprows=sample_rows(testing))
+        elif url.endswith('.zip'):
+            with zipfile.ZipFile(source_file, 'r') as zip_ref:
+                with zip_ref.open(find_crash_csv_member(zip_ref)) as csv_file:
+                    yield from pd.read_csv(csv_file, sep=';', decimal=',', chunksize=chunksize, skiprows=sample_rows(testing))
+        else:
+            raise ValueError("URL must be a .csv or .zip file.")
+
+
+def extract_to_database(url: str,
+                        name: str,
+                        location: str = 'sqlite:///data/data.sqlite',
+                        testing: bool = False,
+                        chunksize: int = 100000,
+                        cache: 'DownloadCache' = None,
+                        bulk: bool = False) -> int:
+    # Streaming alternative to load(name, extract(url)), only one chunk is held in memory
+    rows = 0
+    seconds = 0
+    if_exists = 'replace'
+    for chunk in read_csv_chunks(url, chunksize, cache, testing):
+        record_read(chunk)
+        start = time.perf_counter()
+        load(name, chunk, location, if_exists, bulk, report=False)
+        seconds += time.perf_counter() - start
+        if_exists = 'append'
+        rows += len(chunk)
+    if bulk:
+        report_load(name, rows, seconds)
+    return rows
+
+
+def download_source(url: str, cache: 'DownloadCache' = None) -> tuple[str, bool]:
+    # Local path of the source and whether it is a temporary file to remove after parsing
+    if cache is not None:
+        return cache.fetch(url), False
+    with tempfile.NamedTemporaryFile(suffix=os.path.splitext(url)[1], delete=False) as tmp_file:
+        with requests.get(url, stream=True) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=1024 * 1024):
+                tmp_file.write(chunk)
+    return tmp_file.name, True
+
+
+def parse_source_file(file_path: str, url: str, testing: bool = False) -> pd.DataFrame:
+    # Parse a downloaded source, runs in a worker process of extract_all
+    if url.endswith('.csv'):
+        df = pd.read_csv(file_path, sep=';', skiprows=sample_rows(testing))
+    elif url.endswith('.zip'):
+        with zipfile.ZipFile(file_path, 'r') as zip_ref:
+            with zip_ref.open(find_crash_csv_member(zip_ref)) as csv_file:
+                df = pd.read_csv(csv_file, sep=';', low_memory=False, decimal=',', skiprows=sample_rows(testing))
+    else:
+        raise ValueError("URL must be a .csv or .zip file.")
+
+    return df
+
 
+def extract_all(sources: dict,
+                location: str = 'sqlite:///data/data.sqlite',
+                testing: bool = False,
+                cache: 'DownloadCache' = None,
+                streaming: bool = False,
+                max_workers: int = 4,
+                parse_workers: int = 0,
+                bulk: bool = False,
+                chunksize: int = 100000) -> None:
+    # Extract the independent sources (table name -> URL) concurrently. Downloads run
+    # in a thread pool, parsing optionally in a process pool and writes are serialized.
+    process_pool = ProcessPoolExecutor(parse_workers) if parse_workers > 0 else None
+
+    def extract_source(name: str, url: str) -> None:
+        with StageMetrics(name, location, time.thread_time):
+            if streaming:
+                extract_to_database(url, name, location, testing, chunksize, cache, bulk)
+                return
+            if process_pool is not None:
+                file_path, temporary = download_source(url, cache)
+                try:
+                    data = process_pool.submit(parse_source_file, file_path, url, testing).result()
+                finally:
+                    if temporary:
+                        os.remove(file_path)
+            else:
+                data = extract(url, testing, cache)
+            # The frame is written right away, lean dtypes would only be restored again
+            record_read(data)
+            load(name, data, location, bulk=bulk)
 
-def read_table_from_sqlite(name: str, location: str = 'sqlite:///data/data.sqlite') -> pd.DataFrame:
     try:
-        return pd.read_sql_table(name, location)
-    except:
-        raise ValueError("Table not found in database.")
+        with StageMetrics('extract', location), ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(contextvars.copy_context().run, extract_source, name, url) for name, url in sources.items()]
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Extracting Sources"):
+                future.result()
+    finally:
+        if process_pool is not None:
+            process_pool.shutdown()
+
+
+class DownloadCache:
+    # Content-addressed on-disk cache for the source downloads. The files are
+    # stored under their sha256 checksum and index.json maps every URL to its
+    # checksum, size, ETag and Last-Modified header for conditional revalidation.
+    def __init__(self, directory: str = os.path.join('data', 'cache'), max_size: int = 2 * 1024 ** 3, offline: bool = False):
+        self.directory = directory
+        self.max_size = max_size
+        self.offline = offline
+        self.index_path = os.path.join(directory, 'index.json')
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as index_file:
+                self.index = json.load(index_file)
+        else:
+            self.index = {}
+
+    def path(self, checksum: str) -> str:
+        return os.path.join(self.directory, checksum)
+
+    def cached_path(self, url: str) -> str:
+        # Local path of a cached URL, None if it is not cached
+        entry = self.index.get(url)
+        if entry is not None and os.path.exists(self.path(entry['sha256'])):
+            return self.path(entry['sha256'])
+        return None
+
+    def fetch(self, url: str) -> str:
+        # Return the local path of the URL, revalidating a cached copy with the server
+        cached_path = self.cached_path(url)
+        if self.offline:
+            if cached_path is None:
+                raise ValueError(f"{url} is not in the download cache.")
+            self.touch(url)
+            return cached_path
+
+        headers = {}
+        if cached_path is not None:
+            entry = self.index[url]
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        try:
+            with requests.get(url, headers=headers, stream=True) as response:
+                if response.status_code == 304 and cached_path is not None:
+                    self.touch(url)
+                    return cached_path
+                response.raise_for_status()
+                return self.store(url, response.iter_content(chunk_size=1024 * 1024),
+                                  response.headers.get('ETag'), response.headers.get('Last-Modified'))
+        except requests.RequestException:
+            # Serve the cached copy if the server cannot be reached
+            if cached_path is not None:
+                self.touch(url)
+                return cached_path
+            raise
+
+    def seed(self, url: str, file_path: str, etag: str = None, last_modified: str = None) -> str:
+        # Add a local file, e.g. a test fixture, to the cache as the content of the URL
+        with open(file_path, 'rb') as source_file:
+            return self.store(url, iter(lambda: source_file.read(1024 * 1024), b''), etag, last_modified)
+
+    def store(self, url: str, chunks, etag: str = None, last_modified: str = None) -> str:
+        # Write the chunks to a temporary file while hashing, then move it to its checksum
+        checksum = hashlib.sha256()
+        size = 0
+        file_descriptor, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.part')
+        with os.fdopen(file_descriptor, 'wb') as tmp_file:
+            for chunk in chunks:
+                checksum.update(chunk)
+                tmp_file.write(chunk)
+                size += len(chunk)
+        checksum = checksum.hexdigest()
+        os.replace(tmp_path, self.path(checksum))
+
+        with self.lock:
+            # The previous content of the URL is not counted any more, drop its file unless shared
+            previous = self.index.pop(url, None)
+            if previous is not None and previous['sha256'] != checksum and \
+                    all(other['sha256'] != previous['sha256'] for other in self.index.values()):
+                if os.path.exists(self.path(previous['sha256'])):
+                    os.remove(self.path(previous['sha256']))
+            self.index[url] = {'sha256': checksum,
+                               'size': size,
+                               'etag': etag,
+                               'last_modified': last_modified,
+                               'last_access': time.time()}
+            self.evict(keep=url)
+            self.save_index()
+        return self.path(checksum)
+
+    def touch(self, url: str) -> None:
+        with self.lock:
+            self.index[url]['last_access'] = time.time()
+            self.save_index()
+
+    def evict(self, keep: str = None) -> None:
+        # Remove the least recently used files until the cache fits into max_size
+        sizes = {entry['sha256']: entry['size'] for entry in self.index.values()}
+        total_size = sum(sizes.values())
+        for url, entry in sorted(self.index.items(), key=lambda item: item[1]['last_access']):
+            if total_size <= self.max_size:
+                break
+            if url == keep:
+                continue
+            del self.index[url]
+            # Files are shared between URLs with the same content
+            if all(other['sha256'] != entry['sha256'] for other in self.index.values()):
+                if os.path.exists(self.path(entry['sha256'])):
+                    os.remove(self.path(entry['sha256']))
+                total_size -= sizes[entry['sha256']]
+
+    def save_index(self) -> None:
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as index_file:
+            json.dump(self.index, index_file, indent=2)
+        os.replace(tmp_path, self.index_path)
+
+
+def is_raw_table(name: str) -> bool:
+    # The tables written by the extract step
+    return name == 'weatherData' or (name.startswith('crashData') and name[len('crashData'):].isdigit())
+
+
+def compare_storage_backends(tables: list, location: str = 'sqlite:///data/data.sqlite') -> pd.DataFrame:
+    # Write and read every table with every storage backend in a temporary directory and
+    # report the times in seconds and the size on disk in bytes
+    results = []
+    tmp_folder = tempfile.mkdtemp(prefix='tmp')
+    try:
+        for name in tables:
+            data = read_table_from_sqlite(name, location)
+            for storage in STORAGE_BACKENDS:
+                # Every table gets its own database, so its file size is the size of the table
+                tmp_location = 'sqlite:///' + os.path.join(tmp_folder, f'{name}_{storage}.sqlite')
+                with PipelineContext(storage=storage):
+                    start = time.perf_counter()
+                    load(name, data, tmp_location)
+                    write_time = time.perf_counter() - start
+                    start = time.perf_counter()
+                    read_table_from_sqlite(name, tmp_location)
+                    read_time = time.perf_counter() - start
+                    backend = pipeline_context.storage_for(name, tmp_location)
+                    size = os.path.getsize(backend.path(name) if backend is not None else tmp_location.replace('sqlite:///', ''))
+                results.append({'table': name, 'storage': storage, 'rows': len(data),
+                                'write_seconds': write_time, 'read_seconds': read_time, 'size_bytes': size})
+    finally:
+        shutil.rmtree(tmp_folder)
+    return pd.DataFrame(results)
+
+
+def read_table_from_sqlite(name: str, location: str = 'sqlite:///data/data.sqlite', columns: list = None) -> pd.DataFrame:
+    storage = pipeline_context.storage_for(name, location)
+    if storage is not None:
+        data = storage.read(name, columns)
+    else:
+        try:
+            data = pd.read_sql_table(name, get_engine(location), columns=columns)
+        except:
+            raise ValueError("Table not found in database.")
+    record_read(data)
+    if pipeline_context.lean_dtypes:
+        data = optimize_dtypes(name, data)
+    return data
 
 
 def preprocess_weather_data(location: str = 'sqlite:///data/data.sqlite') -> pd.DataFrame:
@@ -130,7 +1231,11 @@ def preprocess_weather_data(location: str = 'sqlite:///data/data.sqlite') -> pd.
     return weatherData
 
 
-def preprocess_crash_data(name: str, year: int, location: str = 'sqlite:///data/data.sqlite') -> pd.DataFrame:
+def preprocess_crash_data(name: str, year: int, location: str = 'sqlite:///data/data.sqlite', pushdown: bool = False) -> pd.DataFrame:
+    if pushdown:
+        # Let the database drop the rows and columns
+        return preprocess_crash_data_in_sql(name, year, location)
+
     crashData = read_table_from_sqlite(name, location)
     # Rename columns to make them easier to read
     crashData = crashData.rename(columns={'XGCSWGS84': 'Longitude', 'YGCSWGS84': 'Latitude'})
@@ -148,7 +1253,12 @@ def preprocess_crash_data(name: str, year: int, location: str = 'sqlite:///data/
         crashData = crashData.rename(columns={"IstSonstige": "IstSonstig"})
         crashData = crashData.drop(['LINREFX', 'LINREFY', 'OBJECTID'], axis=1)
     else:
-        raise ValueError("Year must be 2017, 2018 or 2019.")
+        # Further years keep every month, with the columns of the 2018 or 2019 layout
+        if 'IstGkfz' in crashData:
+            column = 'IstSonstige' if 'IstSonstige' in crashData else 'IstSonstig'
+            crashData[column] = crashData[column] | crashData['IstGkfz']
+        crashData = crashData.rename(columns={"IstSonstige": "IstSonstig"})
+        crashData = crashData.drop([column for column in CRASH_DROPPED_COLUMNS[None] if column in crashData], axis=1)
     
     # Drop rows with 'IstRad' or 'IstFuss' equal to 1
     crashData = crashData[crashData['IstRad'] != 1]
@@ -163,31 +1273,163 @@ def preprocess_crash_data(name: str, year: int, location: str = 'sqlite:///data/
     return crashData
 
 
+# Columns of the raw crash tables that the pipeline never uses
+CRASH_DROPPED_COLUMNS = {2017: ['LINREFX', 'LINREFY', 'OBJECTID', 'UIDENTSTLA'],
+                         2018: ['LINREFX', 'LINREFY', 'OBJECTID_1'],
+                         2019: ['LINREFX', 'LINREFY', 'OBJECTID'],
+                         None: ['LINREFX', 'LINREFY', 'OBJECTID', 'OBJECTID_1', 'UIDENTSTLA']}
+
+
+def crash_data_query(name: str, year: int, columns: list) -> str:
+    # SQL with the filters of preprocess_crash_data as WHERE clauses and the kept columns as projection.
+    # IS NOT keeps NULL values like the != comparisons in pandas do.
+    if year == 2017:
+        conditions = ['"UMONAT" = 12']
+    elif year == 2018:
+        conditions = []
+    elif year == 2019:
+        conditions = ['"UMONAT" IS NOT 12']
+    else:
+        conditions = []
+    conditions += ['"IstRad" IS NOT 1', '"IstFuss" IS NOT 1', '"UTYP1" IS NOT 3', '"UART" IS NOT 6']
+
+    # Rename columns to make them easier to read
+    aliases = {'XGCSWGS84': 'Longitude', 'YGCSWGS84': 'Latitude'}
+    dropped = CRASH_DROPPED_COLUMNS.get(year, CRASH_DROPPED_COLUMNS[None]) + ['IstRad', 'IstFuss']
+    projection = ', '.join(f'"{column}" AS "{aliases[column]}"' if column in aliases else f'"{column}"'
+                           for column in columns if column not in dropped)
+    return f'SELECT {projection} FROM "{name}" WHERE {" AND ".join(conditions)}'
+
+
+def preprocess_crash_data_in_sql(name: str, year: int, location: str = 'sqlite:///data/data.sqlite') -> pd.DataFrame:
+    # Same result as preprocess_crash_data, but only the needed rows and columns leave the database
+    query = crash_data_query(name, year, table_column_types(name, location))
+    crashData = pd.read_sql_query(query, get_engine(location))
+    record_read(crashData)
+    if pipeline_context.lean_dtypes:
+        crashData = optimize_dtypes(name, crashData)
+    return combine_other_vehicle_columns(crashData, year)
+
+
+def preprocess_crash_data_chunks(name: str, year: int, location: str = 'sqlite:///data/data.sqlite', chunksize: int = 100000):
+    # Yield the rows of preprocess_crash_data in chunks, the filters run in the database
+    query = crash_data_query(name, year, table_column_types(name, location))
+    for crashData in pd.read_sql_query(query, get_engine(location), chunksize=chunksize):
+        record_read(crashData)
+        if pipeline_context.lean_dtypes:
+            crashData = optimize_dtypes(name, crashData)
+        yield combine_other_vehicle_columns(crashData, year)
+
+
+def combine_other_vehicle_columns(crashData: pd.DataFrame, year: int) -> pd.DataFrame:
+    # Combine the other vehicle columns like preprocess_crash_data
+    if year != 2017 and 'IstGkfz' in crashData:
+        column = 'IstSonstige' if 'IstSonstige' in crashData else 'IstSonstig'
+        crashData[column] = crashData[column] | crashData['IstGkfz']
+    return crashData.rename(columns={"IstSonstige": "IstSonstig"})
+
+
+def table_column_types(name: str, location: str = 'sqlite:///data/data.sqlite') -> dict:
+    # Declared SQL type of every column of a table
+    storage = pipeline_context.storage_for(name, location)
+    if storage is not None:
+        return storage.column_types(name)
+    if not table_exists(name, location):
+        raise ValueError("Table not found in database.")
+    with database_connection(location) as conn:
+        return {row[1]: row[2] for row in conn.execute(f'PRAGMA table_info("{name}")').fetchall()}
+
+
 def connect_crash_data_with_weather_data(name: str,
                                         crashData: pd.DataFrame,
                                         threshold_distance: int = 600,
-                                        location: str = 'sqlite:///data/data.sqlite') -> pd.DataFrame:
+                                        location: str = 'sqlite:///data/data.sqlite',
+                                        method: str = 'chunked',
+                                        block_size: int = 512,
+                                        prefilter: bool = True,
+                                        weatherData: pd.DataFrame = None) -> pd.DataFrame:
     
-    weatherData = read_table_from_sqlite('weatherDataID', location)
+    if weatherData is None:
+        weatherData = read_table_from_sqlite('weatherDataID', location)
+    weather_coords = weatherData[['Latitude', 'Longitude']].to_numpy()
+    total_rows = len(crashData)
+
+    # Drop crashes outside every expanded route bounding box before computing any distance
+    if prefilter:
+        crashData = crashData[inside_bounding_boxes(crashData[['Latitude', 'Longitude']].to_numpy(),
+                                                    route_bounding_boxes(weatherData, threshold_distance))]
+    prefiltered_rows = len(crashData)
+    crash_coords = crashData[['Latitude', 'Longitude']].to_numpy()
+
+    if method == 'chunked':
+        # Only block_size x block_size distances are held in memory at once
+        min_distances = calculate_min_distance(crash_coords, weather_coords, block_size, desc=f"Connecting {name} with weatherData")
+    elif method == 'bruteforce':
+        distances = []
+        for _, row in tqdm(crashData.iterrows(), total=crashData.shape[0], desc=f"Connecting {name} with weatherData"):
+            lat1, lon1 = row['Latitude'], row['Longitude']
+            dist = calculate_distance(np.array([(lat1, lon1)]), weather_coords)
+            distances.append(dist)
+        distances = np.concatenate(distances, axis=0) if distances else np.empty(0)
+        distances = distances.reshape(len(crashData), len(weatherData))
+        min_distances = np.min(distances, axis=1, initial=np.inf)
+    else:
+        raise ValueError("Method must be 'chunked' or 'bruteforce'.")
 
-    distances = []
-    for _, row in tqdm(crashData.iterrows(), total=crashData.shape[0], desc=f"Connecting {name} with weatherData"):
-        lat1, lon1 = row['Latitude'], row['Longitude']
-        dist = calculate_distance(np.array([(lat1, lon1)]), weatherData[['Latitude', 'Longitude']].to_numpy())
-        distances.append(dist)
+    # Report how many rows every stage eliminated
+    report_eliminated_rows(name, total_rows, prefiltered_rows, np.count_nonzero(min_distances <= threshold_distance))
 
     # Find matching rows
-    distances = np.concatenate(distances, axis=0)
-    distances = distances.reshape(len(crashData), len(weatherData))
-    return crashData[np.min(distances, axis=1) <= threshold_distance]
+    return crashData[min_distances <= threshold_distance]
+
+
+def report_eliminated_rows(name: str, total_rows: int, prefiltered_rows: int, matching_rows: int) -> None:
+    print(f"{name}: {total_rows} rows, "
+          f"bounding box prefilter removed {total_rows - prefiltered_rows}, "
+          f"distance filter removed {prefiltered_rows - matching_rows}, "
+          f"{matching_rows} remaining")
     
 
-def assign_crash_to_weather_data(filter: int = 0, threshold_distance: int = 600, location: str = 'sqlite:///data/data.sqlite') -> pd.DataFrame:
-    crashData = concat_crash_data(location)
+def assign_crash_to_weather_data(filter: int = 0,
+                                 threshold_distance: int = 600,
+                                 location: str = 'sqlite:///data/data.sqlite',
+                                 method: str = 'grid',
+                                 years: list = None) -> pd.DataFrame:
+    crashData = concat_crash_data(location, years)
     weatherData = read_table_from_sqlite('weatherDataID', location)
 
     crash_coords = crashData[['Latitude', 'Longitude']].values
     weather_coords = weatherData[['Latitude', 'Longitude']].values
+
+    if method == 'grid':
+        # Look up the closest weather point of all crashes in one batched call
+        index = WeatherGridIndex(weather_coords, threshold_distance)
+        closest_weather_idx, _ = index.query(crash_coords)
+        found = closest_weather_idx >= 0
+
+        # Crashes without a weather point within the threshold keep None
+        strecke_values = np.full(len(crashData), None, dtype=object)
+        streckeID_values = np.full(len(crashData), None, dtype=object)
+        strecke_values[found] = weatherData['Strecke'].to_numpy()[closest_weather_idx[found]]
+        streckeID_values[found] = weatherData['StreckeID'].to_numpy()[closest_weather_idx[found]]
+    elif method == 'bruteforce':
+        # Reference implementation comparing every crash with every weather point
+        strecke_values, streckeID_values = assign_crash_to_weather_data_bruteforce(crashData, crash_coords, weatherData, weather_coords, threshold_distance)
+    else:
+        raise ValueError("Method must be 'grid' or 'bruteforce'.")
+
+    # Assign the calculated Strecke values to a new column in crashData
+    crashData['Strecke'] = strecke_values
+    crashData['StreckeID'] = streckeID_values
+
+    return crashData
+
+
+def assign_crash_to_weather_data_bruteforce(crashData: pd.DataFrame,
+                                            crash_coords: np.ndarray,
+                                            weatherData: pd.DataFrame,
+                                            weather_coords: np.ndarray,
+                                            threshold_distance: int = 600) -> tuple[list, list]:
     # Create an empty list to store the corresponding Strecke values
     strecke_values = []
     streckeID_values = []
@@ -210,24 +1452,296 @@ def assign_crash_to_weather_data(filter: int = 0, threshold_distance: int = 600,
         strecke_values.append(strecke_value)
         streckeID_values.append(streckeID_value)
 
-    # Assign the calculated Strecke values to a new column in crashData
+    return strecke_values, streckeID_values
+
+
+def spatial_join_crash_data(crashData: pd.DataFrame,
+                            weatherData: pd.DataFrame,
+                            threshold_distance: int = 600,
+                            prefilter: bool = True,
+                            index: 'WeatherGridIndex' = None,
+                            boxes: pd.DataFrame = None) -> pd.DataFrame:
+    # Nearest weather point, its distance and the within-threshold flag for every crash, and
+    # whether the crash passed the bounding box prefilter. The index and the route boxes can
+    # be passed in when joining many chunks.
+    crash_coords = crashData[['Latitude', 'Longitude']].to_numpy()
+    weather_coords = weatherData[['Latitude', 'Longitude']].to_numpy()
+    closest_weather_idx = np.full(len(crashData), -1, dtype=np.int64)
+    closest_distance = np.full(len(crashData), np.inf)
+
+    # Only crashes inside an expanded route bounding box can be within the threshold
+    if prefilter:
+        if boxes is None:
+            boxes = route_bounding_boxes(weatherData, threshold_distance)
+        candidates = inside_bounding_boxes(crash_coords, boxes)
+    else:
+        candidates = np.ones(len(crashData), dtype=bool)
+
+    if index is None:
+        index = WeatherGridIndex(weather_coords, threshold_distance)
+    closest_weather_idx[candidates], closest_distance[candidates] = index.query(crash_coords[candidates])
+
+    return pd.DataFrame({'WeatherIndex': closest_weather_idx,
+                         'Distance': closest_distance,
+                         'WithinThreshold': closest_weather_idx >= 0,
+                         'Candidate': candidates}, index=crashData.index)
+
+
+def assign_crash_data_from_joins(years: list,
+                                 join_results: dict,
+                                 threshold_distance: int = 600,
+                                 location: str = 'sqlite:///data/data.sqlite') -> pd.DataFrame:
+    weatherData = read_table_from_sqlite('weatherDataID', location)
+
+    crashDataNearby = []
+    for year in years:
+        crashData = read_table_from_sqlite("crashDataNearby" + str(year), location)
+        join = join_results.get(year)
+        if join is None:
+            # The year has been filtered in an earlier run
+            join = spatial_join_crash_data(crashData, weatherData, threshold_distance)
+        crashDataNearby.append((crashData, join))
+
+    # Assign the closest Strecke of the join result to the concatenated crashes
+    crashData = pd.concat([data for data, _ in crashDataNearby], ignore_index=True)
+    join = pd.concat([join for _, join in crashDataNearby], ignore_index=True)
+    found = join['WithinThreshold'].to_numpy()
+    closest_weather_idx = join['WeatherIndex'].to_numpy()[found]
+
+    strecke_values = np.full(len(crashData), None, dtype=object)
+    streckeID_values = np.full(len(crashData), None, dtype=object)
+    strecke_values[found] = weatherData['Strecke'].to_numpy()[closest_weather_idx]
+    streckeID_values[found] = weatherData['StreckeID'].to_numpy()[closest_weather_idx]
     crashData['Strecke'] = strecke_values
     crashData['StreckeID'] = streckeID_values
 
     return crashData
 
 
-def concat_crash_data(location: str = 'sqlite:///data/data.sqlite') -> pd.DataFrame:
+def join_crash_year(year: int,
+                    weatherData: pd.DataFrame,
+                    threshold_distance: int = 600,
+                    location: str = 'sqlite:///data/data.sqlite',
+                    pushdown: bool = False) -> tuple[pd.DataFrame, pd.DataFrame]:
+    # Preprocess the crashes of one year and keep those within the threshold with their join result
+    crashData = preprocess_crash_data("crashData" + str(year), year, location, pushdown)
+    join = spatial_join_crash_data(crashData, weatherData, threshold_distance)
+    crashData = crashData[join['WithinThreshold']]
+    report_eliminated_rows("crashData" + str(year), len(join), np.count_nonzero(join['Candidate']), len(crashData))
+    return crashData, join.loc[crashData.index]
+
+
+def join_crash_year_chunks(year: int,
+                           weatherData: pd.DataFrame,
+                           threshold_distance: int = 600,
+                           location: str = 'sqlite:///data/data.sqlite',
+                           chunksize: int = 100000):
+    # Chunked join_crash_year, yields the crashes of one year within the threshold chunk by chunk
+    index = WeatherGridIndex(weatherData[['Latitude', 'Longitude']].to_numpy(), threshold_distance)
+    boxes = route_bounding_boxes(weatherData, threshold_distance)
+    total_rows = 0
+    prefiltered_rows = 0
+    matching_rows = 0
+    for crashData in preprocess_crash_data_chunks("crashData" + str(year), year, location, chunksize):
+        join = spatial_join_crash_data(crashData, weatherData, threshold_distance, index=index, boxes=boxes)
+        total_rows += len(crashData)
+        prefiltered_rows += np.count_nonzero(join['Candidate'])
+        crashData = crashData[join['WithinThreshold']]
+        matching_rows += len(crashData)
+        yield crashData
+    report_eliminated_rows("crashData" + str(year), total_rows, prefiltered_rows, matching_rows)
+
+
+def assign_crash_data_chunks(years: list,
+                             threshold_distance: int = 600,
+                             location: str = 'sqlite:///data/data.sqlite',
+                             chunksize: int = 100000):
+    # Chunked assign_crash_to_weather_data, yields the crashes of all years with their closest
+    # Strecke. Every chunk has the columns of the concatenated crashDataNearby tables.
+    weatherData = read_table_from_sqlite('weatherDataID', location)
+    index = WeatherGridIndex(weatherData[['Latitude', 'Longitude']].to_numpy(), threshold_distance)
+    columns = list(concat_column_types(["crashDataNearby" + str(year) for year in years], location))
+    for year in years:
+        for crashData in read_table_chunks("crashDataNearby" + str(year), location, chunksize):
+            closest_weather_idx, _ = index.query(crashData[['Latitude', 'Longitude']].to_numpy())
+            found = closest_weather_idx >= 0
+            strecke_values = np.full(len(crashData), None, dtype=object)
+            streckeID_values = np.full(len(crashData), None, dtype=object)
+            strecke_values[found] = weatherData['Strecke'].to_numpy()[closest_weather_idx[found]]
+            streckeID_values[found] = weatherData['StreckeID'].to_numpy()[closest_weather_idx[found]]
+            crashData = crashData.reindex(columns=columns)
+            crashData['Strecke'] = strecke_values
+            crashData['StreckeID'] = streckeID_values
+            yield crashData
+
+
+def concat_column_types(tables: list, location: str = 'sqlite:///data/data.sqlite') -> dict:
+    # Column types of the tables concatenated like pd.concat does it: the columns in the
+    # order they first appear and integer columns that some tables lack turn into floats
+    table_types = [table_column_types(table, location) for table in tables]
+    column_types = {}
+    for types in table_types:
+        for column, column_type in types.items():
+            column_types.setdefault(column, column_type)
+    for column, column_type in column_types.items():
+        if column_type in ('BIGINT', 'INTEGER', 'SMALLINT') and any(column not in types for types in table_types):
+            column_types[column] = 'FLOAT'
+    return column_types
+
+
+def read_table_chunks(name: str, location: str = 'sqlite:///data/data.sqlite', chunksize: int = 100000, columns: list = None):
+    # Chunked read_table_from_sqlite
+    storage = pipeline_context.storage_for(name, location)
+    if storage is not None:
+        chunks = storage.read_chunks(name, chunksize, columns)
+    elif table_exists(name, location):
+        chunks = pd.read_sql_table(name, get_engine(location), columns=columns, chunksize=chunksize)
+    else:
+        raise ValueError("Table not found in database.")
+    for chunk in chunks:
+        record_read(chunk)
+        yield optimize_dtypes(name, chunk) if pipeline_context.lean_dtypes else chunk
+
+
+def load_chunks(name: str,
+                chunks,
+                location: str = 'sqlite:///data/data.sqlite',
+                column_types: dict = None,
+                bulk: bool = False) -> int:
+    # Write an iterator of chunks to one table, only one chunk is held in memory.
+    # With column_types the table is created with these types before the first chunk.
+    storage = pipeline_context.storage_for(name, location)
+    if storage is not None:
+        return storage.write_chunks(name, prepare_chunks(chunks), column_types)
+    rows = 0
+    seconds = 0
+    if_exists = 'replace'
+    if column_types is not None:
+        create_table(name, column_types, location)
+        if_exists = 'append'
+    for chunk in chunks:
+        start = time.perf_counter()
+        load(name, chunk, location, if_exists, bulk, report=False)
+        seconds += time.perf_counter() - start
+        if_exists = 'append'
+        rows += len(chunk)
+    if bulk:
+        report_load(name, rows, seconds)
+    return rows
+
+
+def prepare_chunks(chunks):
+    # The chunks as load writes them, with restored dtypes and counted rows
+    for chunk in chunks:
+        if pipeline_context.lean_dtypes:
+            chunk = restore_dtypes(chunk)
+        record_written(chunk)
+        yield chunk
+
+
+def create_table(name: str, column_types: dict, location: str = 'sqlite:///data/data.sqlite') -> None:
+    # Replace the table by an empty one with the declared column types
+    storage = pipeline_context.storage_for(name, location)
+    if storage is not None:
+        if storage.exists(name):
+            os.remove(storage.path(name))
+        return
+    table = name.replace('"', '""')
+    columns = ', '.join(f'"{column}" {column_type}' for column, column_type in column_types.items())
+    with database_write_lock, database_connection(location) as conn:
+        conn.execute(f'DROP TABLE IF EXISTS "{table}"')
+        conn.execute(f'CREATE TABLE "{table}" ({columns})')
+        conn.commit()
+
+
+def enable_wal(location: str = 'sqlite:///data/data.sqlite') -> None:
+    # In WAL mode the chunked readers of a table do not block the writers of another table
+    with database_connection(location) as conn:
+        conn.execute('PRAGMA journal_mode=WAL')
+
+
+# Weather points of the worker processes, mapped from the file written by CrashYearPool
+worker_weather_data = None
+
+
+def init_crash_year_worker(weather_path: str, lean_dtypes: bool = False) -> None:
+    global worker_weather_data, pipeline_context
+    # Pooled connections must not be shared with the parent process
+    pipeline_context = PipelineContext(pooled=False, lean_dtypes=lean_dtypes)
+
+    # Columns are latitude, longitude and the factorized Strecke
+    weather = np.load(weather_path, mmap_mode='r')
+    worker_weather_data = pd.DataFrame({'Strecke': weather[:, 2],
+                                        'Latitude': weather[:, 0],
+                                        'Longitude': weather[:, 1]})
+
+
+def process_crash_year(year: int,
+                       threshold_distance: int = 600,
+                       location: str = 'sqlite:///data/data.sqlite',
+                       fused: bool = True,
+                       pushdown: bool = False) -> tuple[pd.DataFrame, pd.DataFrame]:
+    # Runs in a worker process, returns the crashDataNearby table and the join result if fused
+    if fused:
+        return join_crash_year(year, worker_weather_data, threshold_distance, location, pushdown)
+    crashData = preprocess_crash_data("crashData" + str(year), year, location, pushdown)
+    crashData = connect_crash_data_with_weather_data("crashData" + str(year), crashData, threshold_distance, location, weatherData=worker_weather_data)
+    return crashData, None
+
+
+class CrashYearPool:
+    # Process pool for the per-year crash stage. The weather points are written
+    # once to a memory-mapped file instead of being pickled for every task.
+    def __init__(self, workers: int = 4, threshold_distance: int = 600, location: str = 'sqlite:///data/data.sqlite', pushdown: bool = False):
+        self.workers = workers
+        self.threshold_distance = threshold_distance
+        self.location = location
+        self.pushdown = pushdown
+        self.executor = None
+        self.tmp_folder = None
+        self.lock = threading.Lock()
+
+    def start(self) -> None:
+        weatherData = read_table_from_sqlite('weatherDataID', self.location)
+        codes, _ = pd.factorize(weatherData['Strecke'])
+        weather = np.column_stack([weatherData['Latitude'], weatherData['Longitude'], codes]).astype(float)
+
+        self.tmp_folder = tempfile.mkdtemp(prefix='tmp')
+        weather_path = os.path.join(self.tmp_folder, 'weatherDataID.npy')
+        np.save(weather_path, weather)
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=init_crash_year_worker,
+                                            initargs=(weather_path, pipeline_context.lean_dtypes))
+
+    def submit(self, year: int, fused: bool = True):
+        # The pool starts with the first year, once weatherDataID is up to date
+        with self.lock:
+            if self.executor is None:
+                self.start()
+        return self.executor.submit(process_crash_year, year, self.threshold_distance, self.location, fused, self.pushdown)
+
+    def close(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown()
+            shutil.rmtree(self.tmp_folder)
+            self.executor = None
+
+
+def concat_crash_data(location: str = 'sqlite:///data/data.sqlite', years: list = None) -> pd.DataFrame:
+    if years is None:
+        years = [2017, 2018, 2019]
     try:
-        crashDataNearby2017 = read_table_from_sqlite('crashDataNearby2017', location)
-        crashDataNearby2018 = read_table_from_sqlite('crashDataNearby2018', location)
-        crashDataNearby2019 = read_table_from_sqlite('crashDataNearby2019', location)
-        return pd.concat([crashDataNearby2017, crashDataNearby2018, crashDataNearby2019], ignore_index=True)
+        return pd.concat([read_table_from_sqlite('crashDataNearby' + str(year), location) for year in years], ignore_index=True)
     except:
         raise ValueError("Crash data from one year not found.")
 
-def filter_wet_snow_crash_data(filter: int = 0, location: str = 'sqlite:///data/data.sqlite'):
-    crashData = read_table_from_sqlite("crashData", location)
+def filter_wet_snow_crash_data(filter: int = 0, location: str = 'sqlite:///data/data.sqlite', chunksize: int = None):
+    if chunksize is not None:
+        # Yield the filtered crashes chunk by chunk
+        return (filter_crash_data(crashData, filter) for crashData in read_table_chunks("crashData", location, chunksize))
+    return filter_crash_data(read_table_from_sqlite("crashData", location), filter)
+
+
+def filter_crash_data(crashData: pd.DataFrame, filter: int = 0) -> pd.DataFrame:
     if filter == 1:
          return crashData[crashData['STRZUSTAND'] == 1]
     elif filter == 2:
@@ -238,7 +1752,10 @@ def filter_wet_snow_crash_data(filter: int = 0, location: str = 'sqlite:///data/
         return crashData
 
 
-def combine_weather_and_crash_data(location: str = 'sqlite:///data/data.sqlite') -> pd.DataFrame:
+def combine_weather_and_crash_data(location: str = 'sqlite:///data/data.sqlite', single_pass: bool = False, chunksize: int = None) -> pd.DataFrame:
+    if single_pass or chunksize is not None:
+        return combine_weather_and_crash_data_single_pass(location, chunksize)
+
     weatherData = read_table_from_sqlite('weatherDataID', location)
     crashData = read_table_from_sqlite("crashData", location)
     crashDataWet = read_table_from_sqlite("crashDataWet", location)
@@ -259,6 +1776,125 @@ def combine_weather_and_crash_data(location: str = 'sqlite:///data/data.sqlite')
     return combinedData
 
 
+def combine_weather_and_crash_data_single_pass(location: str = 'sqlite:///data/data.sqlite', chunksize: int = None) -> pd.DataFrame:
+    # Count all crash categories from one read of crashData in one groupby and merge them once.
+    # With a chunksize the counts of every chunk are added up, so crashData is never held at once.
+    weatherData = read_table_from_sqlite('weatherDataID', location)
+    columns = ['Strecke', 'StreckeID', 'STRZUSTAND']
+    if chunksize is None:
+        counts = count_crash_categories(read_table_from_sqlite("crashData", location, columns=columns))
+    else:
+        counts = count_crash_categories(pd.DataFrame({column: [] for column in columns}))
+        for crashData in read_table_chunks("crashData", location, chunksize, columns):
+            counts = pd.concat([counts, count_crash_categories(crashData)]).groupby(level=['Strecke', 'StreckeID']).sum()
+    return merge_crash_counts(weatherData, counts)
+
+
+def merge_crash_counts(weatherData: pd.DataFrame, counts: pd.DataFrame) -> pd.DataFrame:
+    # Merge the category counts indexed by Strecke and StreckeID into the weather points
+    # A segment without crashes of a category has no row in the grouped filtered table
+    counts = counts.where(counts > 0).reset_index()
+    combinedData = weatherData.merge(counts, on=['Strecke', 'StreckeID'], how='left')
+
+    # The separate merges only turn a count into floats if a segment is missing
+    for column in ['CrashCount', 'CrashCountWet', 'CrashCountSnow', 'CrashCountWetSnow']:
+        if not combinedData[column].hasnans:
+            combinedData[column] = combinedData[column].astype('int64')
+
+    return combinedData
+
+
+def count_crash_categories(crashData: pd.DataFrame) -> pd.DataFrame:
+    # One indicator column per category, with the conditions of filter_wet_snow_crash_data
+    condition = crashData['STRZUSTAND']
+    categories = pd.DataFrame({'Strecke': crashData['Strecke'],
+                               'StreckeID': crashData['StreckeID'],
+                               'CrashCount': 1,
+                               'CrashCountWet': (condition == 1).astype('int64'),
+                               'CrashCountSnow': (condition == 2).astype('int64'),
+                               'CrashCountWetSnow': (condition != 0).astype('int64')})
+    return categories.groupby(['Strecke', 'StreckeID']).sum()
+
+
+def count_crash_categories_per_year(crashData: pd.DataFrame) -> pd.DataFrame:
+    # The category counts per Year, Strecke and StreckeID as columns
+    counts = {year: count_crash_categories(group) for year, group in crashData.groupby('UJAHR')}
+    if not counts:
+        counts = {0: count_crash_categories(crashData)}
+    counts = pd.concat(counts, names=['Year']).reset_index()
+    counts['Year'] = counts['Year'].astype('int64')
+    return counts
+
+
+def crash_counts_per_year(location: str = 'sqlite:///data/data.sqlite', chunksize: int = None) -> pd.DataFrame:
+    # The persisted aggregates for incremental ingestion, the counts of every year in crashData
+    columns = ['UJAHR', 'Strecke', 'StreckeID', 'STRZUSTAND']
+    if chunksize is None:
+        return count_crash_categories_per_year(read_table_from_sqlite("crashData", location, columns=columns))
+    counts = [count_crash_categories_per_year(crashData) for crashData in read_table_chunks("crashData", location, chunksize, columns)]
+    counts = pd.concat(counts or [count_crash_categories_per_year(pd.DataFrame({column: [] for column in columns}))])
+    return counts.groupby(['Year', 'Strecke', 'StreckeID'], as_index=False).sum()
+
+
+def merge_year_crash_counts(year: int, crashData: pd.DataFrame, location: str = 'sqlite:///data/data.sqlite') -> pd.DataFrame:
+    # Replace the counts of the year in crashCounts with those of crashData and return all counts,
+    # so ingesting a year again gives the same aggregates
+    if table_exists('crashCounts', location):
+        counts = read_table_from_sqlite('crashCounts', location)
+    else:
+        # A database transformed before the aggregates were kept
+        counts = crash_counts_per_year(location)
+    yearCounts = count_crash_categories(crashData).reset_index()
+    yearCounts.insert(0, 'Year', year)
+    counts = pd.concat([counts[counts['Year'] != year], yearCounts], ignore_index=True)
+    load('crashCounts', counts, location)
+    return counts
+
+
+def ingested_years(location: str = 'sqlite:///data/data.sqlite') -> list:
+    # The years counted in crashCounts
+    if not table_exists('crashCounts', location):
+        return []
+    return sorted(read_table_from_sqlite('crashCounts', location, columns=['Year'])['Year'].unique().tolist())
+
+
+def ingest_year(year: int,
+                location: str = 'sqlite:///data/data.sqlite',
+                threshold_distance: int = 600,
+                pushdown: bool = True,
+                storage: str = None,
+                lean_dtypes: bool = None) -> None:
+    # Add the crashes of one year to a transformed database without transforming the other years
+    # again. Only the crashes of the year go through the spatial join, their counts per segment
+    # are merged into crashCounts and the weather tables are recomputed from the summed counts.
+    # crashData and the filtered tables keep the earlier years, a full transform rebuilds them.
+    with run_context(storage, lean_dtypes), StageMetrics('ingest', location):
+        # The counts no longer follow crashData, the next transform derives them from it again
+        invalidate_node_fingerprints(['crashCounts', 'weatherCrashData'], location)
+        weatherData = read_table_from_sqlite('weatherDataID', location)
+        name = "crashDataNearby" + str(year)
+        with StageMetrics(name, location):
+            crashData, join = join_crash_year(year, weatherData, threshold_distance, location, pushdown)
+            load(name, crashData, location)
+            # A later transform with the year reuses the table
+            inputs = ["weatherDataID", "crashData" + str(year)]
+            store_node_fingerprints(name, f"threshold_distance={threshold_distance}",
+                                    {table: table_fingerprint(table, location) for table in inputs}, location)
+
+        with StageMetrics('crashCounts', location):
+            crashData = assign_crash_data_from_joins([year], {year: join.reset_index(drop=True)}, threshold_distance, location)
+            counts = merge_year_crash_counts(year, crashData, location)
+
+        with StageMetrics('weatherCrashData', location):
+            counts = counts.drop(columns='Year').groupby(['Strecke', 'StreckeID']).sum()
+            weatherCrashData = add_column_with_normalized_crash_values(merge_crash_counts(weatherData, counts))
+            load("weatherCrashData", weatherCrashData, location)
+        with StageMetrics('weatherCrashDataNormalized', location):
+            load("weatherCrashDataNormalized", normalize_per_Route(location), location)
+        with StageMetrics('weatherCrashDataLOD', location):
+            load("weatherCrashDataLOD", aggregate_levels_of_detail(location), location)
+
+
 def add_column_with_normalized_crash_values(combinedData: pd.DataFrame) -> pd.DataFrame:
     # Fill missing values with 0
     combinedData['CrashCount'] = combinedData['CrashCount'].fillna(0)
@@ -291,7 +1927,7 @@ def add_column_with_normalized_crash_values(combinedData: pd.DataFrame) -> pd.Da
     return combinedData
 
 
-def normalize_per_Route(location: str = 'sqlite:///data/data.sqlite') -> pd.DataFrame:
+def normalize_per_Route(location: str = 'sqlite:///data/data.sqlite', method: str = 'vectorized') -> pd.DataFrame:
     weatherCrashData = read_table_from_sqlite('weatherCrashData', location)
     # Define the columns to be normalized
     columns_to_normalize = ['Nebel', 
@@ -307,6 +1943,11 @@ def normalize_per_Route(location: str = 'sqlite:///data/data.sqlite') -> pd.Data
                             'NormalizedCrashSnow', 
                             'NormalizedCrashWetSnow']
 
+    if method == 'vectorized':
+        return normalize_per_Route_vectorized(weatherCrashData, columns_to_normalize)
+    elif method != 'groupby':
+        raise ValueError("Method must be 'vectorized' or 'groupby'.")
+
     # Create a new dataframe to store the normalized data
     WeatherCrashDataNormalized = weatherCrashData.copy()
 
@@ -334,22 +1975,89 @@ def smooth_crash_data(group: pd.DataFrame, window_size: int = 3) -> pd.DataFrame
     return group
 
 
+def normalize_per_Route_vectorized(weatherCrashData: pd.DataFrame, columns_to_normalize: list, window_size: int = 3) -> pd.DataFrame:
+    # Same result as the groupby method: the rows are ordered by Strecke like groupby.apply
+    # returns them, the min/max of all columns come from one grouped pass and the rolling
+    # means run once over all routes with windows that end at the route boundaries
+    codes, _ = pd.factorize(weatherCrashData['Strecke'], sort=True)
+    order = np.argsort(codes, kind='stable')
+    WeatherCrashDataNormalized = weatherCrashData.iloc[order]
+    codes = codes[order]
+
+    columns = [col for col in columns_to_normalize if WeatherCrashDataNormalized[col].dtype != object]
+    grouped_data = WeatherCrashDataNormalized.groupby(codes)[columns]
+    min_val = grouped_data.transform('min')
+    max_val = grouped_data.transform('max')
+    WeatherCrashDataNormalized[columns] = (WeatherCrashDataNormalized[columns] - min_val) / (max_val - min_val)
+
+    indexer = RouteWindowIndexer(window_size=window_size, codes=codes)
+    for col, smoothed_col in [('NormalizedCrash', 'SmoothedCrash'),
+                              ('NormalizedCrashWet', 'SmoothedCrashWet'),
+                              ('NormalizedCrashSnow', 'SmoothedCrashSnow'),
+                              ('NormalizedCrashWetSnow', 'SmoothedCrashWetSnow')]:
+        WeatherCrashDataNormalized[smoothed_col] = WeatherCrashDataNormalized[col].rolling(window=indexer, min_periods=1).mean()
+
+    return WeatherCrashDataNormalized
+
+
+class RouteWindowIndexer(BaseIndexer):
+    # Centered window of window_size rows like rolling(window_size, center=True), clipped
+    # to the route of every row. The rows have to be sorted by their route codes.
+    def get_window_bounds(self, num_values: int = 0, min_periods: int = None, center: bool = None,
+                          closed: str = None, step: int = None) -> tuple[np.ndarray, np.ndarray]:
+        # First and last row of the route of every row
+        boundaries = np.flatnonzero(np.diff(self.codes)) + 1
+        route = np.searchsorted(boundaries, np.arange(num_values), side='right')
+        route_start = np.concatenate([[0], boundaries])[route]
+        route_end = np.concatenate([boundaries, [num_values]])[route]
+
+        offset = (self.window_size - 1) // 2
+        end = np.arange(1 + offset, num_values + 1 + offset, dtype=np.int64)
+        start = end - self.window_size
+        return np.maximum(start, route_start).astype(np.int64), np.minimum(end, route_end).astype(np.int64)
+
+
+# Bucket sizes in kilometers of the level-of-detail aggregates for the overview map
+LOD_BUCKET_SIZES = [1, 5, 25]
+
+
+def aggregate_levels_of_detail(location: str = 'sqlite:///data/data.sqlite', bucket_sizes: list = None) -> pd.DataFrame:
+    # Merge the route points into buckets of consecutive kilometers per route, one level per bucket size,
+    # with the mean position and the mean NormalizedCrash. The app maps coarser levels at lower zooms.
+    if bucket_sizes is None:
+        bucket_sizes = LOD_BUCKET_SIZES
+    weatherCrashData = read_table_from_sqlite('weatherCrashDataNormalized', location,
+                                              columns=['Strecke', 'Kilometer', 'Latitude', 'Longitude', 'NormalizedCrash'])
+    levels = []
+    for bucket_size in bucket_sizes:
+        bucket = ((weatherCrashData['Kilometer'] - 1) // bucket_size).rename('Bucket')
+        level = weatherCrashData.groupby([weatherCrashData['Strecke'], bucket], sort=False).agg(
+            Kilometer=('Kilometer', 'min'),
+            Latitude=('Latitude', 'mean'),
+            Longitude=('Longitude', 'mean'),
+            NormalizedCrash=('NormalizedCrash', 'mean'),
+            Points=('Kilometer', 'size'))
+        level = level.reset_index().drop(columns='Bucket')
+        level.insert(0, 'Level', bucket_size)
+        levels.append(level)
+    return pd.concat(levels, ignore_index=True)
+
+
 def table_exists(table_name: str, location: str = 'data/data.sqlite') -> bool:
-    # Extract the file path from the location
-    path = location.replace('sqlite:///', '')
-    # Connect to the SQLite database file
-    conn = sqlite3.connect(path)
-    cursor = conn.cursor()
+    storage = pipeline_context.storage_for(table_name, location)
+    if storage is not None:
+        return storage.exists(table_name)
 
-    # Execute a query to check if the table exists
-    cursor.execute(f"SELECT name FROM sqlite_master WHERE type='table' AND name='{table_name}'")
+    # Borrow a connection of the active pipeline context
+    with database_connection(location) as conn:
+        cursor = conn.cursor()
 
-    # Fetch the first result
-    result = cursor.fetchone()
+        # Execute a query to check if the table exists
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table_name,))
 
-    # Close the database connection
-    cursor.close()
-    conn.close()
+        # Fetch the first result
+        result = cursor.fetchone()
+        cursor.close()
 
     # Return True if a result was found, indicating the table exists
     return result is not None
@@ -360,10 +2068,10 @@ def calculate_distance(coords1: np.array, coords2: np.array) -> np.array:
     radius = 6371000
 
     # Convert latitudes and longitudes to radians
-    lat1_rad = np.radians(coords1[:, 0])
-    lon1_rad = np.radians(coords1[:, 1])
-    lat2_rad = np.radians(coords2[:, 0])
-    lon2_rad = np.radians(coords2[:, 1])
+    lat1_rad = np.radians(coords1[..., 0])
+    lon1_rad = np.radians(coords1[..., 1])
+    lat2_rad = np.radians(coords2[..., 0])
+    lon2_rad = np.radians(coords2[..., 1])
 
     # Haversine formula
     dlat = lat2_rad - lat1_rad
@@ -374,9 +2082,301 @@ def calculate_distance(coords1: np.array, coords2: np.array) -> np.array:
     return distance
 
 
-def store_transformed_data_in_own_database(table: str, org_location: str = 'sqlite:///data/data.sqlite', store_location: str = 'sqlite:///data/data_for_app.sqlite') -> None:
+def calculate_min_distance(coords1: np.ndarray, coords2: np.ndarray, block_size: int = 512, desc: str = None) -> np.ndarray:
+    # Keep a running minimum distance per coordinate in coords1 instead of
+    # materializing the full len(coords1) x len(coords2) distance matrix
+    min_distances = np.full(len(coords1), np.inf)
+    for start in tqdm(range(0, len(coords1), block_size), desc=desc):
+        block = coords1[start:start + block_size, np.newaxis, :]
+        block_min = min_distances[start:start + block_size]
+        for weather_start in range(0, len(coords2), block_size):
+            distances = calculate_distance(block, coords2[np.newaxis, weather_start:weather_start + block_size, :])
+            np.minimum(block_min, distances.min(axis=1), out=block_min)
+    return min_distances
+
+
+def distance_to_degrees(distance: float, max_latitude: float) -> tuple[float, float]:
+    # Also takes an array of latitudes and returns an array of longitude degrees
+    # Radius of the Earth in meters
+    radius = 6371000
+
+    # Widen the result by a tiny margin so rounding never drops a match
+    margin = 1 + 1e-6
+
+    # Two points closer than `distance` never differ by more than this in latitude
+    lat_degrees = np.degrees(distance / radius) * margin
+
+    # A degree of longitude shrinks towards the poles, so take the highest
+    # latitude a point within `distance` of the given points can have
+    max_lat = np.radians(np.minimum(np.abs(max_latitude) + lat_degrees, 89.9))
+    sin_half = np.minimum(np.sin(distance / (2 * radius)) / np.cos(max_lat), 1.0)
+    lon_degrees = np.degrees(2 * np.arcsin(sin_half)) * margin
+
+    return lat_degrees, lon_degrees
+
+
+def route_bounding_boxes(weatherData: pd.DataFrame, threshold_distance: int = 600) -> pd.DataFrame:
+    # Bounding box of every route, expanded by the threshold distance
+    boxes = weatherData.groupby('Strecke').agg(min_lat=('Latitude', 'min'),
+                                               max_lat=('Latitude', 'max'),
+                                               min_lon=('Longitude', 'min'),
+                                               max_lon=('Longitude', 'max'))
+    lat_degrees, lon_degrees = distance_to_degrees(threshold_distance, np.maximum(boxes['min_lat'].abs(), boxes['max_lat'].abs()).to_numpy())
+    return boxes.assign(min_lat=boxes['min_lat'] - lat_degrees, max_lat=boxes['max_lat'] + lat_degrees,
+                        min_lon=boxes['min_lon'] - lon_degrees, max_lon=boxes['max_lon'] + lon_degrees)
+
+
+def inside_bounding_boxes(coords: np.ndarray, boxes: pd.DataFrame, batch_size: int = 100000) -> np.ndarray:
+    # True for every coordinate inside at least one of the boxes. The boxes are registered
+    # in the cells of a grid sized by their typical extent. A coordinate in a cell that a box
+    # covers completely is inside, otherwise it is only tested against the boxes crossing its
+    # cell, which are found by a binary search on the cell keys.
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+    inside = np.zeros(len(coords), dtype=bool)
+    if len(boxes) == 0 or len(coords) == 0:
+        return inside
+    bounds = boxes[['min_lat', 'max_lat', 'min_lon', 'max_lon']].to_numpy(dtype=float)
+
+    # A typical box spans about 8 cells per axis and no box more than 64
+    lat_extent = bounds[:, 1] - bounds[:, 0]
+    lon_extent = bounds[:, 3] - bounds[:, 2]
+    lat_step = max(np.median(lat_extent) / 8, lat_extent.max() / 64, 1e-9)
+    lon_step = max(np.median(lon_extent) / 8, lon_extent.max() / 64, 1e-9)
+    row_min, row_max = np.floor(bounds[:, 0] / lat_step).astype(np.int64), np.floor(bounds[:, 1] / lat_step).astype(np.int64)
+    col_min, col_max = np.floor(bounds[:, 2] / lon_step).astype(np.int64), np.floor(bounds[:, 3] / lon_step).astype(np.int64)
+    row_offset, col_offset = row_min.min(), col_min.min()
+    n_rows, n_cols = row_max.max() - row_offset + 1, col_max.max() - col_offset + 1
+
+    # One (cell, box) entry for every cell a box overlaps. Cells inside the border cells of a
+    # box are covered, the others keep the box for the exact test, sorted by the cell key.
+    box_cols = col_max - col_min + 1
+    cells = (row_max - row_min + 1) * box_cols
+    box_idx = np.repeat(np.arange(len(bounds)), cells)
+    offset = np.arange(cells.sum()) - np.repeat(np.cumsum(cells) - cells, cells)
+    rows = row_min[box_idx] + offset // box_cols[box_idx]
+    cols = col_min[box_idx] + offset % box_cols[box_idx]
+    keys = (rows - row_offset) * n_cols + (cols - col_offset)
+    interior = (rows > row_min[box_idx]) & (rows < row_max[box_idx]) & (cols > col_min[box_idx]) & (cols < col_max[box_idx])
+    covered = np.zeros(n_rows * n_cols, dtype=bool)
+    covered[keys[interior]] = True
+    border = ~interior & ~covered[keys]
+    order = np.argsort(keys[border], kind='stable')
+    sorted_keys, sorted_boxes = keys[border][order], box_idx[border][order]
+
+    for start in range(0, len(coords), batch_size):
+        batch = coords[start:start + batch_size]
+        finite = np.isfinite(batch).all(axis=1)
+        rows = np.floor(np.where(finite, batch[:, 0], 0) / lat_step).astype(np.int64) - row_offset
+        cols = np.floor(np.where(finite, batch[:, 1], 0) / lon_step).astype(np.int64) - col_offset
+        valid = finite & (rows >= 0) & (rows < n_rows) & (cols >= 0) & (cols < n_cols)
+        cell_keys = np.where(valid, rows * n_cols + cols, -1)
+        inside[start:start + len(batch)] = valid & covered[np.maximum(cell_keys, 0)]
+        lo = np.searchsorted(sorted_keys, cell_keys, side='left')
+        hi = np.searchsorted(sorted_keys, cell_keys, side='right')
+        hi[~valid] = lo[~valid]
+
+        # Test every coordinate against the boxes of its cell
+        counts = hi - lo
+        pair_coord = np.repeat(np.arange(len(batch)), counts)
+        pair_box = sorted_boxes[np.repeat(lo, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)]
+        lat, lon = batch[pair_coord, 0], batch[pair_coord, 1]
+        hit = ((lat >= bounds[pair_box, 0]) & (lat <= bounds[pair_box, 1]) &
+               (lon >= bounds[pair_box, 2]) & (lon <= bounds[pair_box, 3]))
+        inside[start + pair_coord[hit]] = True
+    return inside
+
+
+class WeatherGridIndex:
+    # Spatial index bucketing the weather points into a regular lat/lon grid.
+    # Every cell is at least `radius` meters wide, so all points within `radius`
+    # of a coordinate lie in its own cell or in one of the eight neighbours.
+    def __init__(self, weather_coords: np.ndarray, radius: float = 600, batch_size: int = 100000):
+        self.coords = np.asarray(weather_coords, dtype=float).reshape(-1, 2)
+        self.radius = radius
+        self.batch_size = batch_size
+
+        # Size the cells for the highest latitude a matching coordinate can have
+        max_lat = np.abs(self.coords[:, 0]).max() if len(self.coords) > 0 else 0
+        self.lat_step, self.lon_step = distance_to_degrees(radius, max_lat)
+
+        # Sort the points by their cell key, so each cell is a contiguous slice
+        rows, cols = self._cells(self.coords)
+        self.row_offset = rows.min() if len(rows) > 0 else 0
+        self.col_offset = cols.min() if len(cols) > 0 else 0
+        self.n_rows = rows.max() - self.row_offset + 1 if len(rows) > 0 else 0
+        self.n_cols = cols.max() - self.col_offset + 1 if len(cols) > 0 else 0
+        keys = (rows - self.row_offset) * self.n_cols + (cols - self.col_offset)
+        self.order = np.argsort(keys, kind='stable')
+        self.sorted_keys = keys[self.order]
+
+    def _cells(self, coords: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        rows = np.floor(coords[:, 0] / self.lat_step).astype(np.int64)
+        cols = np.floor(coords[:, 1] / self.lon_step).astype(np.int64)
+        return rows, cols
+
+    def query(self, crash_coords: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        # Returns the index of the closest weather point and its distance in meters.
+        # Coordinates without a weather point within `radius` get index -1 and distance inf.
+        crash_coords = np.asarray(crash_coords, dtype=float).reshape(-1, 2)
+        closest_idx = np.full(len(crash_coords), -1, dtype=np.int64)
+        closest_distance = np.full(len(crash_coords), np.inf)
+
+        for start in range(0, len(crash_coords), self.batch_size):
+            stop = min(start + self.batch_size, len(crash_coords))
+            idx, distance = self._query_batch(crash_coords[start:stop])
+            closest_idx[start:stop] = idx
+            closest_distance[start:stop] = distance
+
+        return closest_idx, closest_distance
+
+    def _query_batch(self, crash_coords: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        closest_idx = np.full(len(crash_coords), -1, dtype=np.int64)
+        closest_distance = np.full(len(crash_coords), np.inf)
+        if len(self.coords) == 0 or len(crash_coords) == 0:
+            return closest_idx, closest_distance
+
+        finite = np.isfinite(crash_coords).all(axis=1)
+        rows, cols = self._cells(np.where(finite[:, None], crash_coords, 0))
+        rows -= self.row_offset
+        cols -= self.col_offset
+
+        # Collect (crash, weather point) candidate pairs from the 3x3 neighbourhood
+        pair_crash = []
+        pair_point = []
+        for d_row in (-1, 0, 1):
+            for d_col in (-1, 0, 1):
+                r = rows + d_row
+                c = cols + d_col
+                valid = finite & (r >= 0) & (r < self.n_rows) & (c >= 0) & (c < self.n_cols)
+                crash_idx = np.nonzero(valid)[0]
+                keys = r[valid] * self.n_cols + c[valid]
+                first = np.searchsorted(self.sorted_keys, keys, side='left')
+                counts = np.searchsorted(self.sorted_keys, keys, side='right') - first
+
+                # Expand every cell slice into one entry per weather point
+                offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+                pair_crash.append(np.repeat(crash_idx, counts))
+                pair_point.append(self.order[np.repeat(first, counts) + offsets])
+
+        pair_crash = np.concatenate(pair_crash)
+        pair_point = np.concatenate(pair_point)
+        if len(pair_crash) == 0:
+            return closest_idx, closest_distance
+        distances = calculate_distance(crash_coords[pair_crash], self.coords[pair_point])
+
+        # Keep the closest point per crash, ties go to the lowest index like np.argmin
+        order = np.lexsort((pair_point, distances, pair_crash))
+        crashes, first = np.unique(pair_crash[order], return_index=True)
+        best = order[first]
+        within = distances[best] <= self.radius
+        closest_idx[crashes[within]] = pair_point[best[within]]
+        closest_distance[crashes[within]] = distances[best[within]]
+        return closest_idx, closest_distance
+
+
+# Tables of the app database with their keys and their indexes on route, segment and coordinate columns
+PUBLISHED_TABLES = ['weatherCrashData', 'weatherCrashDataNormalized', 'weatherCrashDataLOD']
+PUBLISHED_KEYS = {'weatherCrashData': ['StreckeID'],
+                  'weatherCrashDataNormalized': ['StreckeID'],
+                  'weatherCrashDataLOD': ['Level', 'Strecke', 'Kilometer']}
+PUBLISHED_INDEXES = {'weatherCrashData': [['Strecke', 'Kilometer'], ['Latitude', 'Longitude']],
+                     'weatherCrashDataNormalized': [['Strecke', 'Kilometer'], ['Latitude', 'Longitude']],
+                     'weatherCrashDataLOD': [['Level', 'Latitude', 'Longitude']]}
+
+
+def store_transformed_data_in_own_database(table: str,
+                                           org_location: str = 'sqlite:///data/data.sqlite',
+                                           store_location: str = 'sqlite:///data/data_for_app.sqlite',
+                                           indexed: bool = True) -> None:
+    # Copy the table with its declared key, the indexes of PUBLISHED_INDEXES and, where SQLite
+    # has the R*Tree module, a spatial index <table>_rtree on the coordinates. Without
+    # indexed the table is a plain copy with the column types of to_sql. The table is
+    # replaced in one transaction, a failed publish keeps the previous one.
     data = read_table_from_sqlite(table, org_location)
-    data.to_sql(table, store_location, if_exists='replace', index=False)
+    record_written(data)
+
+    quoted = table.replace('"', '""')
+    key = [column for column in PUBLISHED_KEYS.get(table, []) if column in data] if indexed else []
+    definitions = [f'"{column}" {column_type}' for column, column_type in declared_column_types(table, data).items()]
+    if key:
+        definitions.append('PRIMARY KEY (' + ', '.join(f'"{column}"' for column in key) + ')')
+    placeholders = ', '.join('?' * len(data.columns))
+    with database_write_lock, database_connection(store_location) as conn:
+        # sqlite3 commits DDL outside of an explicit transaction
+        conn.execute('BEGIN')
+        try:
+            conn.execute(f'DROP TABLE IF EXISTS "{quoted}_rtree"')
+            conn.execute(f'DROP TABLE IF EXISTS "{quoted}"')
+            conn.execute(f'CREATE TABLE "{quoted}" ({", ".join(definitions)})')
+            conn.executemany(f'INSERT INTO "{quoted}" VALUES ({placeholders})', data.itertuples(index=False, name=None))
+            for columns in PUBLISHED_INDEXES.get(table, []) if indexed else []:
+                index_columns = ', '.join(f'"{column}"' for column in columns)
+                conn.execute(f'CREATE INDEX "{quoted}_{"_".join(columns)}" ON "{quoted}" ({index_columns})')
+            if indexed and {'Latitude', 'Longitude'} <= set(data.columns) and rtree_available(conn):
+                conn.execute(f'CREATE VIRTUAL TABLE "{quoted}_rtree" USING rtree(id, min_lat, max_lat, min_lon, max_lon)')
+                conn.execute(f'INSERT INTO "{quoted}_rtree" SELECT rowid, "Latitude", "Latitude", "Longitude", "Longitude" FROM "{quoted}" '
+                             'WHERE "Latitude" IS NOT NULL AND "Longitude" IS NOT NULL')
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+
+
+def rtree_available(conn) -> bool:
+    return ('ENABLE_RTREE',) in conn.execute('PRAGMA compile_options').fetchall()
+
+
+def create_route_summary(location: str = 'sqlite:///data/data_for_app.sqlite') -> None:
+    # Precomputed per-route totals of weatherCrashData. SQLite has no materialized views,
+    # so the summary is a table that is rebuilt on every publish.
+    with database_write_lock, database_connection(location) as conn:
+        conn.execute('BEGIN')
+        try:
+            conn.execute('DROP TABLE IF EXISTS "weatherCrashDataRouteSummary"')
+            conn.execute('CREATE TABLE "weatherCrashDataRouteSummary" AS SELECT "Strecke", '
+                         'COUNT(*) AS "Segments", MAX("Kilometer") AS "Kilometers", '
+                         'SUM("CrashCount") AS "CrashCount", SUM("CrashCountWet") AS "CrashCountWet", '
+                         'SUM("CrashCountSnow") AS "CrashCountSnow", SUM("CrashCountWetSnow") AS "CrashCountWetSnow", '
+                         'AVG("NormalizedCrash") AS "NormalizedCrash", AVG("Gesamt") AS "Gesamt", '
+                         'MIN("Latitude") AS "MinLatitude", MAX("Latitude") AS "MaxLatitude", '
+                         'MIN("Longitude") AS "MinLongitude", MAX("Longitude") AS "MaxLongitude" '
+                         'FROM "weatherCrashData" GROUP BY "Strecke"')
+            conn.execute('CREATE UNIQUE INDEX "weatherCrashDataRouteSummary_Strecke" ON "weatherCrashDataRouteSummary" ("Strecke")')
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+
+
+def publish_app_database(location: str = 'sqlite:///data/data.sqlite',
+                         store_location: str = 'sqlite:///data/data_for_app.sqlite',
+                         tables: list = None) -> str:
+    # Copy the tables of the app with their keys and indexes, add the route summary, update
+    # the statistics of the query planner and stamp a new data version, which is returned
+    tables = tables or PUBLISHED_TABLES
+    for table in tables:
+        store_transformed_data_in_own_database(table, location, store_location)
+    if 'weatherCrashData' in tables:
+        create_route_summary(store_location)
+    with database_write_lock, database_connection(store_location) as conn:
+        conn.execute('ANALYZE')
+        conn.commit()
+    return stamp_data_version(store_location)
+
+
+def stamp_data_version(location: str = 'sqlite:///data/data_for_app.sqlite') -> str:
+    # New version of the published tables, the readers of the app database reload their caches when it changes
+    version = uuid.uuid4().hex
+    with database_write_lock, database_connection(location) as conn:
+        try:
+            conn.execute('CREATE TABLE IF NOT EXISTS data_version (version TEXT, created_at FLOAT)')
+            conn.execute('DELETE FROM data_version')
+            conn.execute('INSERT INTO data_version VALUES (?, ?)', (version, time.time()))
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+    return version
 
 
 def print_message(message: str) -> None:
@@ -385,7 +2385,22 @@ def print_message(message: str) -> None:
     print('------------------')
 
 
-def main(testing: bool = False) -> None:
+def main(testing: bool = False,
+         streaming: bool = False,
+         use_cache: bool = True,
+         extract_workers: int = 4,
+         parse_workers: int = 0,
+         bulk: bool = True,
+         storage: str = 'sqlite',
+         lean_dtypes: bool = True,
+         years: list = None,
+         chunksize: int = None,
+         source_url: str = None,
+         incremental: bool = False) -> None:
+    # A chunksize runs the pipeline out of core, the sources are streamed into the database.
+    # A source_url takes the sources by file name from a stand-in server instead, e.g. the
+    # local fixture server of the tests, so a run needs no network.
+    # Incremental runs on a transformed database only ingest the years that are not counted yet.
     print_message(f'Testing: {testing}')
     if testing:
         location = 'sqlite:///project/test/test_data.sqlite'
@@ -395,29 +2410,44 @@ def main(testing: bool = False) -> None:
         final_location = 'sqlite:///project/final_report/final_report_data.sqlite'
 
     
-    print_message('Begin Extracting')
-    urls = ["https://www.mcloud.de/downloads/mcloud/96EA9CD1-0695-4461-90B1-BC6F6B0E0729/Resultat_HotSpot_Analyse_neu.csv",
-            "https://www.opengeodata.nrw.de/produkte/transport_verkehr/unfallatlas/Unfallorte2017_EPSG25832_CSV.zip",
-            "https://www.opengeodata.nrw.de/produkte/transport_verkehr/unfallatlas/Unfallorte2018_EPSG25832_CSV.zip",
-            "https://www.opengeodata.nrw.de/produkte/transport_verkehr/unfallatlas/Unfallorte2019_EPSG25832_CSV.zip"]
-    
-    if not table_exists("weatherData", location):
-        load("weatherData", extract(urls[0], testing), location)
-
-    years = [2017, 2018, 2019]
-    for i, year in tqdm(enumerate(years), total=len(years), desc="Extracting Years"):
-    #for i, year in enumerate(years):
-        if not table_exists("crashData"+str(year), location):
-            load("crashData"+str(year), extract(urls[i+1], testing), location)
-    print_message('Finished Extracting')
-    
-    print_message('Begin Transforming')
-    transform(location)
-    store_transformed_data_in_own_database('weatherCrashData', location, final_location)
-    store_transformed_data_in_own_database('weatherCrashDataNormalized', location, final_location)
-    print_message('Finished Transforming')
+    # Share one pooled engine per database between all stages of the run, the
+    # intermediate tables go to the selected storage and the app database stays SQLite
+    # Every stage of the run is logged and appended to pipeline_runs
+    with PipelineContext(storage=storage, lean_dtypes=lean_dtypes) as context, StageMetrics('main', location) as run:
+        print_message('Begin Extracting')
+        if years is None:
+            years = [2017, 2018, 2019]
+        urls = ["https://www.mcloud.de/downloads/mcloud/96EA9CD1-0695-4461-90B1-BC6F6B0E0729/Resultat_HotSpot_Analyse_neu.csv"]
+        urls += [f"https://www.opengeodata.nrw.de/produkte/transport_verkehr/unfallatlas/Unfallorte{year}_EPSG25832_CSV.zip" for year in years]
+        if source_url is not None:
+            urls = [source_url.rstrip('/') + '/' + url.rsplit('/', 1)[1] for url in urls]
+        
+        # Serve repeated downloads from the local cache, a stand-in server is local already
+        cache = DownloadCache(os.path.join('data', 'cache')) if use_cache and source_url is None else None
+
+        # Extract the sources that are not in the database yet
+        names = ["weatherData"] + ["crashData" + str(year) for year in years]
+        sources = {name: url for name, url in zip(names, urls) if not table_exists(name, location)}
+        extract_all(sources, location, testing, cache, streaming or chunksize is not None, max_workers=extract_workers,
+                    parse_workers=parse_workers, bulk=bulk, chunksize=chunksize or 100000)
+        print_message('Finished Extracting')
+        
+        print_message('Begin Transforming')
+        if incremental and table_exists('weatherCrashData', location):
+            for year in sorted(set(years) - set(ingested_years(location))):
+                ingest_year(year, location)
+        else:
+            transform(location, years=years, chunksize=chunksize)
+        with StageMetrics('store', location):
+            publish_app_database(location, final_location)
+        print_message('Finished Transforming')
+        print_message(f'Database connections opened: {context.connections_opened}')
 
+    report = pipeline_run_report(run.run_id, location)
+    print_message('Pipeline run ' + run.run_id)
+    print(report.drop(columns=['run_id', 'started_at']).to_string(index=False))
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
     main(False)
\ No newline at end of file
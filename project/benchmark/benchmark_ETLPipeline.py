@@ -0,0 +1,295 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import project.ETLPipeline as etl
+
+# Benchmark of the transform stages on synthetic sources. Run it from the repository root:
+#   python -m project.benchmark.benchmark_ETLPipeline --crashes 10000 100000 1000000 --output benchmark_results.json
+
+# Columns of the raw sources, in the order of the real files
+WEATHER_COLUMNS = ['Nebel', 'Black Ice', 'Neuschnee', 'Gesamtschnee', 'Niederschlag', 'Wind', 'Windböen', 'Gesamt']
+CRASH_COLUMNS = {
+    2017: ['OBJECTID', 'UIDENTSTLA', 'ULAND', 'UREGBEZ', 'UKREIS', 'UGEMEINDE', 'UJAHR', 'UMONAT', 'USTUNDE',
+           'UWOCHENTAG', 'UKATEGORIE', 'UART', 'UTYP1', 'IstRad', 'IstPKW', 'IstFuss', 'IstKrad', 'IstSonstig',
+           'LICHT', 'STRZUSTAND', 'LINREFX', 'LINREFY', 'XGCSWGS84', 'YGCSWGS84'],
+    2018: ['OBJECTID_1', 'ULAND', 'UREGBEZ', 'UKREIS', 'UGEMEINDE', 'UJAHR', 'UMONAT', 'USTUNDE', 'UWOCHENTAG',
+           'UKATEGORIE', 'UART', 'UTYP1', 'ULICHTVERH', 'IstRad', 'IstPKW', 'IstFuss', 'IstKrad', 'IstGkfz',
+           'IstSonstig', 'STRZUSTAND', 'LINREFX', 'LINREFY', 'XGCSWGS84', 'YGCSWGS84'],
+    2019: ['OBJECTID', 'ULAND', 'UREGBEZ', 'UKREIS', 'UGEMEINDE', 'UJAHR', 'UMONAT', 'USTUNDE', 'UWOCHENTAG',
+           'UKATEGORIE', 'UART', 'UTYP1', 'ULICHTVERH', 'IstRad', 'IstPKW', 'IstFuss', 'IstKrad', 'IstGkfz',
+           'IstSonstige', 'LINREFX', 'LINREFY', 'XGCSWGS84', 'YGCSWGS84', 'STRZUSTAND']
+}
+
+# Value ranges (low inclusive, high exclusive) of the integer columns of the crash tables
+CRASH_VALUE_RANGES = {'ULAND': (1, 17), 'UREGBEZ': (0, 10), 'UKREIS': (0, 100), 'UGEMEINDE': (0, 1000),
+                      'UMONAT': (1, 13), 'USTUNDE': (0, 24), 'UWOCHENTAG': (1, 8), 'UKATEGORIE': (1, 4),
+                      'UART': (0, 10), 'UTYP1': (1, 8), 'ULICHTVERH': (0, 3), 'LICHT': (0, 3), 'STRZUSTAND': (0, 3)}
+
+
+def generate_weather_data(routes: int = 10, points_per_route: int = 300, seed: int = 0, spacing: float = 1) -> pd.DataFrame:
+    # Straight routes somewhere in Germany with one weather point every spacing kilometers
+    rng = np.random.default_rng(seed)
+    start_lat = np.repeat(rng.uniform(47.5, 54, routes), points_per_route)
+    start_lon = np.repeat(rng.uniform(6, 14, routes), points_per_route)
+    angle = np.repeat(rng.uniform(0, 2 * np.pi, routes), points_per_route)
+    kilometer = np.tile(np.arange(points_per_route) * spacing, routes)
+    weatherData = pd.DataFrame({'Strecke': np.repeat([f'Route_{route + 1}' for route in range(routes)], points_per_route),
+                                'Lat [°]': start_lat + kilometer * 0.009 * np.sin(angle),
+                                'Lon [°]': start_lon + kilometer * 0.014 * np.cos(angle)})
+    for column in WEATHER_COLUMNS:
+        weatherData[column] = rng.uniform(0, 100, len(weatherData)).round(1)
+    return weatherData
+
+
+def generate_crash_data(year: int, rows: int, weatherData: pd.DataFrame, seed: int = 0, nearby_fraction: float = 0.5) -> pd.DataFrame:
+    # Crashes with the columns of the given year, a fraction of them close to a weather point
+    # and the rest anywhere in Germany. Further years get the columns of 2019.
+    rng = np.random.default_rng(seed + year)
+    nearby = rng.random(rows) < nearby_fraction
+    points = rng.integers(0, len(weatherData), rows)
+    latitude = np.where(nearby, weatherData['Lat [°]'].to_numpy()[points] + rng.normal(0, 0.003, rows), rng.uniform(47.3, 55, rows))
+    longitude = np.where(nearby, weatherData['Lon [°]'].to_numpy()[points] + rng.normal(0, 0.005, rows), rng.uniform(5.9, 15, rows))
+
+    crashData = {}
+    for column in CRASH_COLUMNS.get(year, CRASH_COLUMNS[2019]):
+        if column == 'XGCSWGS84':
+            crashData[column] = longitude
+        elif column == 'YGCSWGS84':
+            crashData[column] = latitude
+        elif column in ('LINREFX', 'LINREFY'):
+            crashData[column] = rng.uniform(280000, 6100000, rows).round(3)
+        elif column == 'UIDENTSTLA':
+            crashData[column] = pd.Series(np.arange(rows)).map(lambda i: f"U{year}{i:09d}").to_numpy()
+        elif column.startswith('OBJECTID'):
+            crashData[column] = np.arange(1, rows + 1)
+        elif column == 'UJAHR':
+            crashData[column] = np.full(rows, year)
+        elif column.startswith('Ist'):
+            crashData[column] = (rng.random(rows) < 0.2).astype(np.int64)
+        else:
+            crashData[column] = rng.integers(*CRASH_VALUE_RANGES[column], rows)
+    return pd.DataFrame(crashData)
+
+
+def write_sources(location: str,
+                  crashes: int,
+                  years: list = None,
+                  routes: int = 10,
+                  points_per_route: int = 300,
+                  seed: int = 0) -> None:
+    # Write weatherData and the crashData{year} tables like the extract step, the crashes are split over the years
+    years = years or [2017, 2018, 2019]
+    weatherData = generate_weather_data(routes, points_per_route, seed)
+    etl.bulk_load('weatherData', weatherData, location)
+    for i, year in enumerate(years):
+        rows = crashes // len(years) + (1 if i < crashes % len(years) else 0)
+        etl.bulk_load('crashData' + str(year), generate_crash_data(year, rows, weatherData, seed), location)
+
+
+def measure(stage: str, function, *args, memory: bool = True, **kwargs) -> tuple:
+    # Run the stage and return its result with wall time, CPU time and peak memory. The memory is
+    # traced in a second run, so the overhead of tracemalloc does not distort the times.
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    result = function(*args, **kwargs)
+    record = {'stage': stage,
+              'wall_seconds': time.perf_counter() - start_wall,
+              'cpu_seconds': time.process_time() - start_cpu,
+              'peak_memory_bytes': None}
+    if memory:
+        tracemalloc.start()
+        try:
+            function(*args, **kwargs)
+            record['peak_memory_bytes'] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result, record
+
+
+def benchmark_scale(crashes: int,
+                    directory: str,
+                    years: list = None,
+                    routes: int = 10,
+                    points_per_route: int = 300,
+                    threshold_distance: int = 600,
+                    memory: bool = True,
+                    seed: int = 0,
+                    app_queries: bool = False) -> list:
+    # Benchmark every transform stage on freshly generated sources with the given number of crashes
+    years = years or [2017, 2018, 2019]
+    location = 'sqlite:///' + os.path.join(directory, f'benchmark_{crashes}.sqlite')
+    write_sources(location, crashes, years, routes, points_per_route, seed)
+    records = []
+
+    def add(record: dict, rows_in: int, rows_out: int, **parameters) -> None:
+        record.update({'crashes': crashes, 'rows_in': rows_in, 'rows_out': rows_out, 'parameters': parameters})
+        records.append(record)
+
+    etl.load('weatherDataID', etl.preprocess_weather_data(location), location)
+    weatherData = etl.read_table_from_sqlite('weatherDataID', location)
+
+    for year in years:
+        name = 'crashData' + str(year)
+        rows = len(etl.read_table_from_sqlite(name, location, columns=['UMONAT']))
+        crashData, record = measure('preprocess_crash_data', etl.preprocess_crash_data, name, year, location, memory=memory)
+        add(record, rows, len(crashData), year=year, pushdown=False)
+        pushdownData, record = measure('preprocess_crash_data', etl.preprocess_crash_data, name, year, location, pushdown=True, memory=memory)
+        add(record, rows, len(pushdownData), year=year, pushdown=True)
+
+        crashDataNearby, record = measure('connect_crash_data_with_weather_data', etl.connect_crash_data_with_weather_data,
+                                          name, crashData, threshold_distance, location, weatherData=weatherData, memory=memory)
+        add(record, len(crashData), len(crashDataNearby), year=year, method='chunked')
+        etl.load('crashDataNearby' + str(year), crashDataNearby, location)
+
+    nearby_rows = sum(len(etl.read_table_from_sqlite('crashDataNearby' + str(year), location, columns=['UMONAT'])) for year in years)
+    crashData, record = measure('assign_crash_to_weather_data', etl.assign_crash_to_weather_data,
+                                0, threshold_distance, location, years=years, memory=memory)
+    add(record, nearby_rows, int(crashData['Strecke'].notna().sum()), method='grid')
+    etl.load('crashData', crashData, location)
+
+    combinedData, record = measure('combine_weather_and_crash_data', etl.combine_weather_and_crash_data, location, True, memory=memory)
+    add(record, len(crashData), len(combinedData), single_pass=True)
+    etl.load('weatherCrashData', etl.add_column_with_normalized_crash_values(combinedData), location)
+
+    normalized, record = measure('normalize_per_Route', etl.normalize_per_Route, location, memory=memory)
+    add(record, len(combinedData), len(normalized), method='vectorized')
+
+    if app_queries:
+        etl.load('weatherCrashDataNormalized', normalized, location)
+        etl.load('weatherCrashDataLOD', etl.aggregate_levels_of_detail(location), location)
+        records += benchmark_app_queries(location, directory, crashes)
+
+    return records
+
+
+def benchmark_app_queries(location: str, directory: str, crashes: int = None, repeats: int = 20) -> list:
+    # Median latency of the typical queries on the app database, once for a plain to_sql copy
+    # of the tables and once for the published database with keys, indexes and route summary
+    records = []
+    for indexed in (False, True):
+        path = os.path.join(directory, f"app_{crashes}_{'indexed' if indexed else 'plain'}.sqlite")
+        if indexed:
+            etl.publish_app_database(location, 'sqlite:///' + path)
+        else:
+            for table in etl.PUBLISHED_TABLES:
+                etl.store_transformed_data_in_own_database(table, location, 'sqlite:///' + path, indexed=False)
+
+        conn = sqlite3.connect(path)
+        try:
+            rows = conn.execute('SELECT COUNT(*) FROM "weatherCrashDataNormalized"').fetchone()[0]
+            strecke, strecke_id, latitude, longitude = conn.execute(
+                'SELECT "Strecke", "StreckeID", "Latitude", "Longitude" FROM "weatherCrashDataNormalized" LIMIT 1 OFFSET ?', (rows // 2,)).fetchone()
+            summary = ('SELECT * FROM "weatherCrashDataRouteSummary"' if indexed else
+                       'SELECT "Strecke", COUNT(*), MAX("Kilometer"), SUM("CrashCount"), SUM("CrashCountWet"), SUM("CrashCountSnow"), '
+                       'SUM("CrashCountWetSnow"), AVG("NormalizedCrash"), AVG("Gesamt"), MIN("Latitude"), MAX("Latitude"), '
+                       'MIN("Longitude"), MAX("Longitude") FROM "weatherCrashData" GROUP BY "Strecke"')
+            queries = {
+                'strecke': ('SELECT * FROM "weatherCrashDataNormalized" WHERE "Strecke" = ?', (strecke,)),
+                'streckeid': ('SELECT * FROM "weatherCrashDataNormalized" WHERE "StreckeID" = ?', (strecke_id,)),
+                'bbox': ('SELECT * FROM "weatherCrashDataNormalized" WHERE "Latitude" BETWEEN ? AND ? AND "Longitude" BETWEEN ? AND ?',
+                         (latitude - .05, latitude + .05, longitude - .05, longitude + .05)),
+                'lod': ('SELECT * FROM "weatherCrashDataLOD" WHERE "Level" = ?', (25,)),
+                'route_summary': (summary, ())
+            }
+            for query, (statement, parameters) in queries.items():
+                latencies = []
+                for _ in range(repeats):
+                    start = time.perf_counter()
+                    result = conn.execute(statement, parameters).fetchall()
+                    latencies.append(time.perf_counter() - start)
+                records.append({'stage': 'app_query', 'wall_seconds': float(np.median(latencies)), 'cpu_seconds': None,
+                                'peak_memory_bytes': None, 'crashes': crashes, 'rows_in': rows, 'rows_out': len(result),
+                                'parameters': {'query': query, 'indexed': indexed}})
+        finally:
+            conn.close()
+    return records
+
+
+def git_commit() -> str:
+    # Commit of the benchmarked code, None outside of a git checkout
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(scales: list,
+                   output: str = 'benchmark_results.json',
+                   years: list = None,
+                   routes: int = 10,
+                   points_per_route: int = 300,
+                   memory: bool = True,
+                   seed: int = 0,
+                   app_queries: bool = False) -> dict:
+    # Benchmark every scale in a temporary directory and write the results as JSON
+    tmp_folder = tempfile.mkdtemp(prefix='tmp')
+    try:
+        records = []
+        for crashes in scales:
+            etl.print_message(f'Benchmarking {crashes} crashes')
+            records += benchmark_scale(crashes, tmp_folder, years, routes, points_per_route, memory=memory, seed=seed,
+                                       app_queries=app_queries)
+    finally:
+        shutil.rmtree(tmp_folder)
+
+    results = {'commit': git_commit(),
+               'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'python': platform.python_version(),
+               'pandas': pd.__version__,
+               'numpy': np.__version__,
+               'machine': platform.machine(),
+               'routes': routes,
+               'points_per_route': points_per_route,
+               'results': records}
+    if output is not None:
+        with open(output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+    return results
+
+
+def compare_results(baseline: dict, current: dict) -> pd.DataFrame:
+    # Wall time and peak memory of two benchmark runs side by side, ratios above 1 are regressions
+    def frame(results: dict) -> pd.DataFrame:
+        records = pd.DataFrame(results['results'])
+        records['parameters'] = records['parameters'].map(lambda parameters: json.dumps(parameters, sort_keys=True))
+        return records.groupby(['crashes', 'stage', 'parameters'])[['wall_seconds', 'peak_memory_bytes']].sum()
+
+    comparison = frame(baseline).join(frame(current), lsuffix='_baseline', rsuffix='_current', how='inner')
+    comparison['wall_ratio'] = comparison['wall_seconds_current'] / comparison['wall_seconds_baseline']
+    comparison['memory_ratio'] = comparison['peak_memory_bytes_current'] / comparison['peak_memory_bytes_baseline']
+    return comparison
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark the ETLPipeline stages on synthetic data.')
+    parser.add_argument('--crashes', type=int, nargs='+', default=[10000, 100000], help='Numbers of crashes to benchmark.')
+    parser.add_argument('--years', type=int, nargs='+', default=[2017, 2018, 2019], help='Years the crashes are split over.')
+    parser.add_argument('--routes', type=int, default=10, help='Number of routes of the weather data.')
+    parser.add_argument('--points-per-route', type=int, default=300, help='Weather points per route.')
+    parser.add_argument('--output', default='benchmark_results.json', help='JSON file of the results.')
+    parser.add_argument('--compare', help='JSON file of an earlier run to compare with.')
+    parser.add_argument('--no-memory', action='store_true', help='Skip the memory profiling runs.')
+    parser.add_argument('--app-queries', action='store_true', help='Also measure the query latency of the app database before and after publishing.')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.crashes, args.output, args.years, args.routes, args.points_per_route, not args.no_memory,
+                             app_queries=args.app_queries)
+    print(pd.DataFrame(results['results']).assign(parameters=lambda records: records['parameters'].map(json.dumps)).to_string())
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            print(compare_results(json.load(baseline_file), results).to_string())
+
+
+if __name__ == "__main__":
+    main()
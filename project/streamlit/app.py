@@ -3,11 +3,13 @@ import pandas as pd
 import plotly.graph_objects as go
 import plotly.express as px
 
-# Load weatherCrashDataNormalized
-weatherCrashDataNormalized = pd.read_sql_table('weatherCrashDataNormalized', 'sqlite:///data/data_for_app.sqlite')
+from app_data import load_app_data, level_for_zoom
+
+# Load weatherCrashDataNormalized, cached for the process until the database changes
+appData = load_app_data('weatherCrashDataNormalized', 'data/data_for_app.sqlite')
 
 # Get unique values of Strecke
-strecke_values = weatherCrashDataNormalized['Strecke'].unique()
+strecke_values = appData.routes
 
 # Set title
 st.title("Weather Crash Data Heatmap")
@@ -17,12 +19,14 @@ selected_strecke = st.selectbox('Select Strecke', ['All'] + list(strecke_values)
 
 # Filter the data for the selected Strecke
 if selected_strecke == 'All':
-    filtered_data = weatherCrashDataNormalized
-    zoom = 4.5
+    # Map the route points merged into buckets, the finer the further the map is zoomed in
+    zoom = st.slider('Zoom', 4.0, 10.0, 4.5, 0.5)
+    levelsOfDetail = load_app_data('weatherCrashDataLOD', 'data/data_for_app.sqlite', key='Level')
+    filtered_data = levelsOfDetail.route(level_for_zoom(zoom))
     color_column = 'Strecke'
     selected_checkboxes = []  # Initialize an empty list for selected checkboxes
 else:
-    filtered_data = weatherCrashDataNormalized[weatherCrashDataNormalized['Strecke'] == selected_strecke]
+    filtered_data = appData.route(selected_strecke)
     zoom = 5
     color_column = 'NormalizedCrash'
     checkboxes = ['Nebel', 'Black Ice', 'Neuschnee', 'Gesamtschnee', 'Niederschlag', 'Wind', 'Windböen', 'Gesamt', 'NormalizedCrash']
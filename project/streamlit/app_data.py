@@ -0,0 +1,85 @@
+import contextlib
+import os
+import sqlite3
+import threading
+
+import pandas as pd
+import sqlalchemy
+
+# Data layer of the app. Streamlit reruns app.py on every interaction, but imported
+# modules live as long as the process, so the tables are read once per process and
+# only again when the database file changes.
+
+APP_DATABASE = 'data/data_for_app.sqlite'
+
+# Lowest map zoom at which each bucket size in kilometers of weatherCrashDataLOD is shown
+LOD_MIN_ZOOM = {1: 9, 5: 7, 25: 0}
+
+
+class AppData:
+    # A table of the app database with the rows of every key, the Strecke by default, next
+    # to each other and the row slice of every key, so selecting a route needs no scan of the table
+    def __init__(self, table: pd.DataFrame, version: str, key: str = 'Strecke'):
+        codes, keys = pd.factorize(table[key])
+        order = codes.argsort(kind='stable')
+        self.table = table.iloc[order].reset_index(drop=True)
+        self.version = version
+        self.keys = list(keys)
+        bounds = codes[order].searchsorted(range(len(keys) + 1))
+        self.slices = {value: slice(bounds[i], bounds[i + 1]) for i, value in enumerate(self.keys)}
+
+    @property
+    def routes(self) -> list:
+        return self.keys
+
+    def route(self, strecke) -> pd.DataFrame:
+        # Rows of one key, empty for an unknown one
+        return self.table.iloc[self.slices.get(strecke, slice(0, 0))]
+
+
+def database_key(path: str) -> tuple:
+    # Changes whenever the database or its write-ahead log is written
+    key = ()
+    for file_path in (path, path + '-wal'):
+        if os.path.exists(file_path):
+            stat = os.stat(file_path)
+            key += (stat.st_mtime_ns, stat.st_size)
+    return key
+
+
+def read_data_version(conn: sqlite3.Connection, key: tuple) -> str:
+    # The version stamp of the pipeline, the file state for databases without one
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='data_version'").fetchone():
+        row = conn.execute('SELECT version FROM data_version').fetchone()
+        if row is not None:
+            return row[0]
+    return '-'.join(str(value) for value in key)
+
+
+# Loaded tables per (path, table, key) with the database key they were read at
+loaded_data = {}
+loaded_data_lock = threading.Lock()
+
+
+def load_app_data(table: str = 'weatherCrashDataNormalized', path: str = APP_DATABASE, key: str = 'Strecke') -> AppData:
+    # The cached table, read again only if the database changed since it was loaded.
+    # Concurrent sessions wait for a running load instead of reading the table twice.
+    database = database_key(path)
+    with loaded_data_lock:
+        cached = loaded_data.get((path, table, key))
+        if cached is not None and cached[0] == database:
+            return cached[1]
+        engine = sqlalchemy.create_engine('sqlite:///' + path)
+        try:
+            with contextlib.closing(engine.raw_connection()) as conn:
+                version = read_data_version(conn, database)
+            data = AppData(pd.read_sql_table(table, engine), version, key)
+        finally:
+            engine.dispose()
+        loaded_data[(path, table, key)] = (database, data)
+        return data
+
+
+def level_for_zoom(zoom: float) -> int:
+    # Finest bucket size of the level-of-detail table for the zoom of the map
+    return min(bucket_size for bucket_size, min_zoom in LOD_MIN_ZOOM.items() if zoom >= min_zoom)
@@ -0,0 +1,255 @@
+import argparse
+import collections
+import contextlib
+import hashlib
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from app_data import APP_DATABASE, database_key, read_data_version
+
+# Read-only HTTP queries over the app database. Like app.py it imports its siblings by
+# module name, run it from the repository root:
+#   python project/streamlit/query_service.py --database data/data_for_app.sqlite --port 8502
+# GET /<table>/strecke/<Strecke>
+# GET /<table>/streckeid/<StreckeID>
+# GET /<table>/bbox?min_lat=..&max_lat=..&min_lon=..&max_lon=..
+# GET /version
+
+# Tables the service answers queries on, table names are never taken from the request as is
+QUERY_TABLES = ['weatherCrashData', 'weatherCrashDataNormalized']
+
+# The statements stay constant, so every pooled connection prepares them once and reuses
+# them from the statement cache of sqlite3 with new parameters
+QUERIES = {
+    'strecke': 'SELECT * FROM "{table}" WHERE "Strecke" = ?',
+    'streckeid': 'SELECT * FROM "{table}" WHERE "StreckeID" = ?',
+    'bbox': 'SELECT * FROM "{table}" WHERE "Latitude" BETWEEN ? AND ? AND "Longitude" BETWEEN ? AND ?'
+}
+
+# Bounding box query over the R*Tree index of the publish step. The R*Tree stores 32 bit
+# floats, so the candidates are checked against the exact coordinates again.
+RTREE_BBOX_QUERY = ('SELECT t.* FROM "{table}" AS t JOIN "{table}_rtree" AS r ON t.rowid = r.id '
+                    'WHERE r.max_lat >= ? AND r.min_lat <= ? AND r.max_lon >= ? AND r.min_lon <= ? '
+                    'AND t."Latitude" BETWEEN ? AND ? AND t."Longitude" BETWEEN ? AND ? ORDER BY t.rowid')
+
+
+class ReadConnectionPool:
+    # Read-only sqlite3 connections shared by the request threads. At most size connections
+    # exist, a request waits up to timeout seconds for a free one. After reset the
+    # connections of the previous database are closed when they come back. The condition
+    # wakes a waiting request whenever a connection or the room for a new one is free.
+    def __init__(self, path: str, size: int = 8, timeout: float = 5):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self.idle = []
+        self.condition = threading.Condition()
+        self.created = 0
+        self.generation = 0
+
+    def connect(self) -> sqlite3.Connection:
+        uri = 'file:' + urllib.parse.quote(os.path.abspath(self.path)) + '?mode=ro'
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False, cached_statements=(len(QUERIES) + 1) * len(QUERY_TABLES) + 8)
+        conn.execute('PRAGMA query_only = ON')
+        return conn
+
+    @contextlib.contextmanager
+    def connection(self):
+        generation, conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(generation, conn)
+
+    def acquire(self) -> tuple:
+        # Raises queue.Empty if no connection becomes free in time
+        deadline = time.monotonic() + self.timeout
+        with self.condition:
+            while not self.idle and self.created >= self.size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise queue.Empty
+                self.condition.wait(remaining)
+            if self.idle:
+                return self.idle.pop()
+            self.created += 1
+            generation = self.generation
+        try:
+            return generation, self.connect()
+        except:
+            with self.condition:
+                self.created -= 1
+                self.condition.notify()
+            raise
+
+    def release(self, generation: int, conn: sqlite3.Connection) -> None:
+        with self.condition:
+            stale = generation != self.generation
+            if stale:
+                self.created -= 1
+            else:
+                self.idle.append((generation, conn))
+            self.condition.notify()
+        if stale:
+            conn.close()
+
+    def reset(self) -> None:
+        with self.condition:
+            self.generation += 1
+            stale, self.idle = self.idle, []
+            self.created -= len(stale)
+            self.condition.notify_all()
+        for _, conn in stale:
+            conn.close()
+
+
+class QueryService:
+    # Answers the queries from the pooled connections and caches the responses with their
+    # ETag. The ETag contains the data version of the pipeline, so a new publish of the
+    # database changes every ETag and drops the cached responses.
+    def __init__(self, path: str = APP_DATABASE, pool_size: int = 8, cache_size: int = 256):
+        self.path = path
+        self.pool = ReadConnectionPool(path, pool_size)
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.database = None
+        self.version = None
+        self.rtree_tables = set()
+
+    def current_version(self) -> str:
+        database = database_key(self.path)
+        with self.lock:
+            if database == self.database:
+                return self.version
+
+        # Read the new database on a dedicated connection outside the lock, so a publish under
+        # load neither blocks the other requests nor waits for a pooled connection
+        conn = self.pool.connect()
+        try:
+            version = read_data_version(conn, database)
+            rtree_tables = {table for table in QUERY_TABLES if conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = ?", (table + '_rtree',)).fetchone()}
+        finally:
+            conn.close()
+        with self.lock:
+            if database != self.database:
+                self.pool.reset()
+                self.cache.clear()
+                self.database, self.version, self.rtree_tables = database, version, rtree_tables
+            return self.version
+
+    def query(self, path: str, parameters: dict) -> tuple[str, bytes]:
+        # ETag and JSON body of the request, LookupError for unknown paths and
+        # ValueError for invalid parameters
+        version = self.current_version()
+        target = (path, tuple(sorted((name, tuple(values)) for name, values in parameters.items())))
+        with self.lock:
+            if (version, target) in self.cache:
+                self.cache.move_to_end((version, target))
+                return self.cache[(version, target)]
+
+        if path.strip('/') == 'version':
+            body = {'version': version}
+        else:
+            table, kind, arguments = parse_query(path, parameters)
+            statement = QUERIES[kind]
+            if kind == 'bbox' and table in self.rtree_tables:
+                statement, arguments = RTREE_BBOX_QUERY, arguments * 2
+            with self.pool.connection() as conn:
+                cursor = conn.execute(statement.format(table=table), arguments)
+                rows = cursor.fetchall()
+            body = {'version': version, 'columns': [column[0] for column in cursor.description], 'rows': rows}
+
+        etag = '"' + version + '-' + hashlib.sha1(repr(target).encode()).hexdigest()[:16] + '"'
+        response = etag, json.dumps(body).encode()
+        with self.lock:
+            if version == self.version:
+                self.cache[(version, target)] = response
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return response
+
+
+def parse_query(path: str, parameters: dict) -> tuple[str, str, tuple]:
+    # Table, query and statement parameters of a request path
+    parts = [urllib.parse.unquote(part) for part in path.strip('/').split('/')]
+    if len(parts) < 2 or parts[0] not in QUERY_TABLES or parts[1] not in QUERIES:
+        raise LookupError(f"Unknown query {path}.")
+    table, kind = parts[0], parts[1]
+    if kind == 'bbox':
+        if len(parts) != 2:
+            raise LookupError(f"Unknown query {path}.")
+        try:
+            bounds = [float(parameters[name][0]) for name in ('min_lat', 'max_lat', 'min_lon', 'max_lon')]
+        except (KeyError, ValueError):
+            raise ValueError("A bbox query needs numeric min_lat, max_lat, min_lon and max_lon.")
+        return table, kind, tuple(bounds)
+    if len(parts) != 3:
+        raise LookupError(f"Unknown query {path}.")
+    return table, kind, (parts[2],)
+
+
+class QueryRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        url = urllib.parse.urlsplit(self.path)
+        try:
+            etag, body = self.server.service.query(url.path, urllib.parse.parse_qs(url.query))
+        except LookupError as e:
+            return self.send_error(404, str(e))
+        except ValueError as e:
+            return self.send_error(400, str(e))
+        except queue.Empty:
+            return self.send_error(503, "No database connection available.")
+
+        if etag in [tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def create_query_server(path: str = APP_DATABASE, host: str = '127.0.0.1', port: int = 8502, pool_size: int = 8) -> ThreadingHTTPServer:
+    # Every request runs in its own thread, the database connections come from the pool
+    server = ThreadingHTTPServer((host, port), QueryRequestHandler)
+    server.daemon_threads = True
+    server.service = QueryService(path, pool_size)
+    return server
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Read-only HTTP queries over the app database.')
+    parser.add_argument('--database', default=APP_DATABASE, help='Path of the app database.')
+    parser.add_argument('--host', default='127.0.0.1', help='Host to listen on.')
+    parser.add_argument('--port', type=int, default=8502, help='Port to listen on.')
+    parser.add_argument('--pool-size', type=int, default=8, help='Number of pooled read connections.')
+    args = parser.parse_args()
+
+    server = create_query_server(args.database, args.host, args.port, args.pool_size)
+    print(f"Serving {args.database} at http://{args.host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
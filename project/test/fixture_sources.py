@@ -0,0 +1,72 @@
+import argparse
+import contextlib
+import functools
+import os
+import threading
+import zipfile
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+from project.benchmark.benchmark_ETLPipeline import generate_weather_data, generate_crash_data
+
+# Small stand-ins of the pipeline sources with the file names, formats and columns of the
+# real files, so main can run without network:
+#   python -m project.test.fixture_sources data/fixtures
+# serves them and prints the URL to pass to main(source_url=...).
+
+
+def write_fixture_sources(directory: str,
+                          years: list = None,
+                          crashes_per_year: int = 20000,
+                          routes: int = 10,
+                          points_per_route: int = 300,
+                          seed: int = 0) -> None:
+    # The weather csv of mcloud and one zipped Unfallatlas csv per year. The weather points
+    # are 50 m apart, so most crashes near a route still find a point within the threshold
+    # distance after the 5% testing sample.
+    years = years or [2017, 2018, 2019]
+    os.makedirs(directory, exist_ok=True)
+    weatherData = generate_weather_data(routes, points_per_route, seed, spacing=.05)
+    weatherData.to_csv(os.path.join(directory, 'Resultat_HotSpot_Analyse_neu.csv'), sep=';', index=False)
+    for year in years:
+        crashData = generate_crash_data(year, crashes_per_year, weatherData, seed, nearby_fraction=.8)
+        with zipfile.ZipFile(os.path.join(directory, f'Unfallorte{year}_EPSG25832_CSV.zip'), 'w', zipfile.ZIP_DEFLATED) as zip_file:
+            zip_file.writestr(f'csv/Unfallorte{year}_LinRef.txt', crashData.to_csv(sep=';', decimal=',', index=False))
+
+
+@contextlib.contextmanager
+def serve_directory(directory: str):
+    # Serve the files of a directory on a local HTTP server
+    handler = functools.partial(QuietHTTPRequestHandler, directory=str(directory))
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+class QuietHTTPRequestHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Write and serve stand-ins of the pipeline sources.')
+    parser.add_argument('directory', help='Directory of the fixture files.')
+    parser.add_argument('--years', type=int, nargs='+', default=[2017, 2018, 2019], help='Years of the crash sources.')
+    parser.add_argument('--crashes', type=int, default=20000, help='Crashes per year.')
+    args = parser.parse_args()
+
+    write_fixture_sources(args.directory, args.years, args.crashes)
+    with serve_directory(args.directory) as url:
+        print(f"Serving the sources at {url}, stop with Ctrl+C")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,33 @@
 import pytest
 import sqlite3
 import numpy as np
+import pandas as pd
 import os
+import sys
+import json
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor
+import zipfile
 
 import project.ETLPipeline as etl
+import project.benchmark.benchmark_ETLPipeline as benchmark
+from project.test.fixture_sources import write_fixture_sources, serve_directory
+
+# The app modules import their siblings by module name, like streamlit runs them
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'streamlit'))
+from app_data import load_app_data, level_for_zoom
+from query_service import create_query_server, ReadConnectionPool
 
 @pytest.fixture(scope='session', autouse=True)
-def setup_and_teardown_session():
+def setup_and_teardown_session(tmp_path_factory):
     # Function to run at the beginning of the test session
     print("Running setup at the start of the test session")
-    # Run your function here
-    etl.main(testing=True)
+    # Run your function here, with the sources served from local fixtures
+    fixtures = tmp_path_factory.mktemp('fixtures')
+    write_fixture_sources(fixtures)
+    with serve_directory(fixtures) as url:
+        etl.main(testing=True, source_url=url)
 
     # Teardown step
     yield
@@ -26,6 +43,73 @@ def remove_test_file():
     if os.path.exists('project/test/test_data_for_app.sqlite'):
         os.remove('project/test/test_data_for_app.sqlite')
 
+def write_crash_zip(path, rows=250):
+    # Write a dummy Unfallatlas archive with the crash csv in the 'csv' folder
+    rng = np.random.default_rng(4)
+    crashData = pd.DataFrame({
+        'OBJECTID': np.arange(rows),
+        'UMONAT': rng.integers(1, 13, rows),
+        'STRZUSTAND': rng.integers(0, 3, rows),
+        'XGCSWGS84': rng.uniform(6, 15, rows).round(6),
+        'YGCSWGS84': rng.uniform(47, 55, rows).round(6)
+    })
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        zip_file.writestr('csv/Unfallorte.txt', crashData.to_csv(sep=';', decimal=',', index=False))
+    return crashData
+
+
+def write_raw_database(location, rows=2000):
+    # Write dummy weatherData and crashData tables with the columns of the real sources
+    rng = np.random.default_rng(5)
+    routes = ['Route_A', 'Route_B', 'Route_C']
+    weatherData = pd.DataFrame({
+        'Strecke': np.repeat(routes, 100),
+        'Lat [°]': np.concatenate([np.linspace(48, 48.9, 100), np.linspace(50, 50.9, 100), np.linspace(52, 52.5, 100)]),
+        'Lon [°]': np.concatenate([np.linspace(9, 10.3, 100), np.linspace(11, 9.7, 100), np.full(100, 13.0)])
+    })
+    for column in ['Nebel', 'Black Ice', 'Neuschnee', 'Gesamtschnee', 'Niederschlag', 'Wind', 'Windböen', 'Gesamt']:
+        weatherData[column] = rng.uniform(0, 100, len(weatherData)).round(1)
+    weatherData.to_sql('weatherData', location, index=False)
+
+    columns = {
+        2017: ['OBJECTID', 'UIDENTSTLA', 'ULAND', 'UREGBEZ', 'UKREIS', 'UGEMEINDE', 'UJAHR', 'UMONAT', 'USTUNDE',
+               'UWOCHENTAG', 'UKATEGORIE', 'UART', 'UTYP1', 'IstRad', 'IstPKW', 'IstFuss', 'IstKrad', 'IstSonstig',
+               'LICHT', 'STRZUSTAND', 'LINREFX', 'LINREFY', 'XGCSWGS84', 'YGCSWGS84'],
+        2018: ['OBJECTID_1', 'ULAND', 'UREGBEZ', 'UKREIS', 'UGEMEINDE', 'UJAHR', 'UMONAT', 'USTUNDE', 'UWOCHENTAG',
+               'UKATEGORIE', 'UART', 'UTYP1', 'ULICHTVERH', 'IstRad', 'IstPKW', 'IstFuss', 'IstKrad', 'IstGkfz',
+               'IstSonstig', 'STRZUSTAND', 'LINREFX', 'LINREFY', 'XGCSWGS84', 'YGCSWGS84'],
+        2019: ['OBJECTID', 'ULAND', 'UREGBEZ', 'UKREIS', 'UGEMEINDE', 'UJAHR', 'UMONAT', 'USTUNDE', 'UWOCHENTAG',
+               'UKATEGORIE', 'UART', 'UTYP1', 'ULICHTVERH', 'IstRad', 'IstPKW', 'IstFuss', 'IstKrad', 'IstGkfz',
+               'IstSonstige', 'LINREFX', 'LINREFY', 'XGCSWGS84', 'YGCSWGS84', 'STRZUSTAND']
+    }
+    for year, year_columns in columns.items():
+        # Half of the crashes happen close to a route
+        points = rng.integers(0, len(weatherData), rows)
+        crashData = pd.DataFrame({
+            'XGCSWGS84': np.where(np.arange(rows) % 2 == 0, weatherData['Lon [°]'].to_numpy()[points] + rng.normal(0, 0.005, rows), rng.uniform(6, 15, rows)),
+            'YGCSWGS84': np.where(np.arange(rows) % 2 == 0, weatherData['Lat [°]'].to_numpy()[points] + rng.normal(0, 0.003, rows), rng.uniform(47, 55, rows)),
+            'UIDENTSTLA': [f"{year}{i:08d}" for i in range(rows)],
+            'UJAHR': year,
+            'UMONAT': rng.integers(1, 13, rows),
+            'STRZUSTAND': rng.integers(0, 3, rows),
+            'LINREFX': rng.uniform(280000, 900000, rows),
+            'LINREFY': rng.uniform(5200000, 6100000, rows)
+        })
+        for column in year_columns:
+            if column.startswith('OBJECTID'):
+                crashData[column] = np.arange(rows)
+            elif column.startswith('Ist'):
+                crashData[column] = (rng.random(rows) < 0.2).astype(int)
+            elif column not in crashData:
+                crashData[column] = rng.integers(0, 8, rows)
+        crashData[year_columns].to_sql('crashData' + str(year), location, index=False)
+
+
+def assert_tables_equal(location, other_location, tables):
+    for table in tables:
+        pd.testing.assert_frame_equal(pd.read_sql_table(table, location), pd.read_sql_table(table, other_location))
+
+
 def test_tables_exist():
     # Connect to the SQLite database
     conn = sqlite3.connect('project/test/test_data.sqlite') 
@@ -72,6 +156,742 @@ def test_calculate_distance():
     assert pytest.approx(distance, abs=10) == 1000, "Distance calculation incorrect."
 
 
+def test_weather_grid_index_matches_bruteforce():
+    # Define dummy weather points roughly 1 km apart and crashes scattered around them
+    rng = np.random.default_rng(0)
+    weather_coords = np.column_stack([np.linspace(48, 50, 200), np.linspace(9, 11, 200)])
+    crash_coords = np.column_stack([rng.uniform(47.9, 50.1, 2000), rng.uniform(8.9, 11.1, 2000)])
+
+    # Look up the closest weather point with the grid index
+    closest_idx, closest_distance = etl.WeatherGridIndex(weather_coords, 600).query(crash_coords)
+
+    # Check if every crash gets the same weather point as the brute-force search
+    for i, crash_coord in enumerate(crash_coords):
+        distances = etl.calculate_distance(np.array([crash_coord]), weather_coords)
+        if distances.min() <= 600:
+            assert closest_idx[i] == np.argmin(distances), "Closest weather point mismatch."
+            assert closest_distance[i] == distances.min(), "Closest distance mismatch."
+        else:
+            assert closest_idx[i] == -1, "Crash outside the threshold was assigned."
+
+
+def test_calculate_min_distance_in_blocks():
+    # Define dummy coordinates that do not fill up the last block
+    rng = np.random.default_rng(1)
+    coords1 = np.column_stack([rng.uniform(48, 50, 250), rng.uniform(9, 11, 250)])
+    coords2 = np.column_stack([rng.uniform(48, 50, 70), rng.uniform(9, 11, 70)])
+
+    # Calculate the running minimum with a block size smaller than both inputs
+    min_distances = etl.calculate_min_distance(coords1, coords2, block_size=32)
+
+    # Check if the result matches the minimum of the full distance matrix
+    expected = np.array([etl.calculate_distance(np.array([coord]), coords2).min() for coord in coords1])
+    assert np.array_equal(min_distances, expected), "Blocked minimum distance incorrect."
+
+
+def test_bounding_box_prefilter_keeps_nearby_crashes():
+    # Define two dummy routes and crashes scattered around them
+    rng = np.random.default_rng(2)
+    weatherData = pd.DataFrame({
+        'Strecke': ['A'] * 50 + ['B'] * 50,
+        'Latitude': np.r_[np.linspace(48, 48.5, 50), np.linspace(52, 52.5, 50)],
+        'Longitude': np.r_[np.linspace(9, 9.5, 50), np.linspace(12, 11.5, 50)]
+    })
+    crash_coords = np.column_stack([rng.uniform(47.9, 52.6, 5000), rng.uniform(8.9, 12.1, 5000)])
+
+    # Apply the prefilter
+    inside = etl.inside_bounding_boxes(crash_coords, etl.route_bounding_boxes(weatherData, 600))
+    min_distances = etl.calculate_min_distance(crash_coords, weatherData[['Latitude', 'Longitude']].to_numpy())
+
+    # Check if no crash within the threshold was dropped and distant crashes were
+    assert inside[min_distances <= 600].all(), "Prefilter dropped a crash within the threshold."
+    assert not inside.all(), "Prefilter did not drop any crash."
+
+
+def test_inside_bounding_boxes_matches_every_box_test():
+    # Many overlapping boxes of very different sizes and coordinates on and off their edges
+    rng = np.random.default_rng(4)
+    lat, lon = rng.uniform(47, 55, 2000), rng.uniform(6, 15, 2000)
+    size = rng.exponential(.05, (2000, 2))
+    size[:5] *= 100
+    boxes = pd.DataFrame({'min_lat': lat, 'max_lat': lat + size[:, 0], 'min_lon': lon, 'max_lon': lon + size[:, 1]})
+    coords = np.column_stack([rng.uniform(46, 56, 20000), rng.uniform(5, 16, 20000)])
+    coords[:100] = boxes[['max_lat', 'min_lon']].to_numpy()[:100]
+    coords[100, 0] = np.nan
+
+    # Check if the grid lookup agrees with testing every box
+    expected = np.zeros(len(coords), dtype=bool)
+    for box in boxes.itertuples():
+        expected |= ((coords[:, 0] >= box.min_lat) & (coords[:, 0] <= box.max_lat) &
+                     (coords[:, 1] >= box.min_lon) & (coords[:, 1] <= box.max_lon))
+    assert np.array_equal(etl.inside_bounding_boxes(coords, boxes, batch_size=3000), expected), "Grid lookup differs."
+
+
+def test_spatial_join_crash_data():
+    # Define a dummy route and crashes scattered around it
+    rng = np.random.default_rng(3)
+    weatherData = pd.DataFrame({
+        'Strecke': ['A'] * 100,
+        'Latitude': np.linspace(48, 49, 100),
+        'Longitude': np.linspace(9, 10, 100)
+    })
+    crashData = pd.DataFrame({
+        'Latitude': rng.uniform(47.9, 49.1, 3000),
+        'Longitude': rng.uniform(8.9, 10.1, 3000)
+    }, index=np.arange(3000) * 2)
+
+    # Join the crashes with the weather points in one pass
+    join = etl.spatial_join_crash_data(crashData, weatherData, 600)
+
+    # Check if the join agrees with the separate proximity filter and assignment
+    weather_coords = weatherData[['Latitude', 'Longitude']].to_numpy()
+    min_distances = etl.calculate_min_distance(crashData[['Latitude', 'Longitude']].to_numpy(), weather_coords)
+    assert join.index.equals(crashData.index), "Join result is not aligned with the crashes."
+    assert np.array_equal(join['WithinThreshold'], min_distances <= 600), "Within-threshold flag incorrect."
+    assert (join['Candidate'] | ~join['WithinThreshold']).all(), "Crash within threshold was prefiltered."
+    assert not join['Candidate'].all(), "Prefilter removed no crash."
+    for i, crash_coord in enumerate(crashData[['Latitude', 'Longitude']].to_numpy()[join['WithinThreshold']]):
+        distances = etl.calculate_distance(np.array([crash_coord]), weather_coords)
+        assert join['WeatherIndex'][join['WithinThreshold']].iloc[i] == np.argmin(distances), "Closest weather point mismatch."
+
+
+def test_extract_to_database_streams_zip(tmp_path):
+    # Serve a dummy crash archive locally
+    crashData = write_crash_zip(tmp_path / 'crashes.zip')
+    location = f"sqlite:///{tmp_path / 'stream.sqlite'}"
+
+    # Stream the archive into the database in small chunks
+    with serve_directory(tmp_path) as url:
+        rows = etl.extract_to_database(f"{url}/crashes.zip", 'crashData', location, chunksize=64)
+
+    # Check if all rows arrived without writing to a 'tmp' folder
+    assert rows == len(crashData), "Not all rows were streamed."
+    pd.testing.assert_frame_equal(pd.read_sql_table('crashData', location), crashData)
+    assert not os.path.exists('tmp'), "Streaming extraction wrote to the 'tmp' folder."
+
+
+@pytest.mark.parametrize('streaming', [False, True])
+def test_testing_samples_while_parsing(tmp_path, streaming):
+    crashData = write_crash_zip(tmp_path / 'crashes.zip', rows=4000)
+    location = f"sqlite:///{tmp_path / 'sample.sqlite'}"
+
+    # The sample of a test run keeps the columns and about 5% of the rows in file order
+    with serve_directory(tmp_path) as url:
+        if streaming:
+            etl.extract_to_database(f"{url}/crashes.zip", 'crashData', location, testing=True, chunksize=500)
+            sample = pd.read_sql_table('crashData', location)
+        else:
+            sample = etl.extract(f"{url}/crashes.zip", testing=True)
+    assert list(sample.columns) == list(crashData.columns), "Sample lost columns."
+    assert 100 < len(sample) < 320, "Sample is not about 5% of the rows."
+    assert sample['OBJECTID'].is_monotonic_increasing, "Sample is not drawn while parsing."
+
+
+def test_download_cache(tmp_path):
+    # Serve a dummy crash archive locally
+    (tmp_path / 'server').mkdir()
+    write_crash_zip(tmp_path / 'server' / 'crashes.zip')
+    cache = etl.DownloadCache(str(tmp_path / 'cache'))
+
+    # Download it once and revalidate it with the server
+    with serve_directory(tmp_path / 'server') as url:
+        first_path = cache.fetch(f"{url}/crashes.zip")
+        second_path = cache.fetch(f"{url}/crashes.zip")
+        cached_url = f"{url}/crashes.zip"
+    assert first_path == second_path, "Revalidated download was stored twice."
+    assert cache.index[cached_url]['last_modified'] is not None, "Last-Modified header was not stored."
+
+    # Check if the cache works offline and is shared with a new cache instance
+    offline_cache = etl.DownloadCache(str(tmp_path / 'cache'), offline=True)
+    pd.testing.assert_frame_equal(etl.extract(cached_url, cache=offline_cache),
+                                  etl.handle_crash_zip(cached_url, offline_cache))
+
+
+def test_download_cache_seed_and_eviction(tmp_path):
+    # Seed the cache with two fixture files that do not fit into it together
+    (tmp_path / 'first.csv').write_bytes(b'a' * 600)
+    (tmp_path / 'second.csv').write_bytes(b'b' * 600)
+    cache = etl.DownloadCache(str(tmp_path / 'cache'), max_size=1000, offline=True)
+    cache.seed('https://example.org/first.csv', str(tmp_path / 'first.csv'))
+    cache.seed('https://example.org/second.csv', str(tmp_path / 'second.csv'))
+
+    # Check if the least recently used file was evicted
+    assert cache.cached_path('https://example.org/first.csv') is None, "Cache exceeded its maximum size."
+    with open(cache.fetch('https://example.org/second.csv'), 'rb') as cached_file:
+        assert cached_file.read() == b'b' * 600, "Cached content incorrect."
+    with pytest.raises(ValueError):
+        cache.fetch('https://example.org/first.csv')
+
+
+def test_download_cache_replaces_changed_content(tmp_path):
+    # Seed one URL with three different contents and a second URL with the last one
+    cache = etl.DownloadCache(str(tmp_path / 'cache'), max_size=1000, offline=True)
+    for content in [b'a', b'b', b'c']:
+        (tmp_path / 'source.csv').write_bytes(content * 400)
+        cache.seed('https://example.org/source.csv', str(tmp_path / 'source.csv'))
+    cache.seed('https://example.org/mirror.csv', str(tmp_path / 'source.csv'))
+
+    # Check if only the current content is kept on disk
+    files = [path for path in (tmp_path / 'cache').iterdir() if path.name != 'index.json']
+    assert len(files) == 1 and sum(path.stat().st_size for path in files) == 400, "Previous content was not removed."
+
+    # A changed URL keeps the file that another URL still references
+    (tmp_path / 'source.csv').write_bytes(b'd' * 400)
+    cache.seed('https://example.org/source.csv', str(tmp_path / 'source.csv'))
+    with open(cache.fetch('https://example.org/mirror.csv'), 'rb') as cached_file:
+        assert cached_file.read() == b'c' * 400, "Shared file was removed."
+
+
+@pytest.mark.parametrize('parse_workers, streaming', [(0, False), (2, False), (0, True)])
+def test_extract_all_concurrently(tmp_path, parse_workers, streaming):
+    # Serve a dummy weather csv and crash archives locally
+    (tmp_path / 'server').mkdir()
+    weatherData = pd.DataFrame({'Strecke': ['Route_A', 'Route_B'], 'Lat [°]': [48.1, 48.2], 'Lon [°]': [9.1, 9.2]})
+    weatherData.to_csv(tmp_path / 'server' / 'weather.csv', sep=';', index=False)
+    crashData = write_crash_zip(tmp_path / 'server' / 'crashes.zip')
+    location = f"sqlite:///{tmp_path / 'concurrent.sqlite'}"
+
+    # Extract all sources with a thread pool
+    with serve_directory(tmp_path / 'server') as url:
+        sources = {'weatherData': f"{url}/weather.csv",
+                   'crashData2017': f"{url}/crashes.zip",
+                   'crashData2018': f"{url}/crashes.zip"}
+        etl.extract_all(sources, location, streaming=streaming, max_workers=3, parse_workers=parse_workers)
+
+    # Check if every source was written to its own table
+    pd.testing.assert_frame_equal(pd.read_sql_table('weatherData', location), weatherData)
+    pd.testing.assert_frame_equal(pd.read_sql_table('crashData2017', location), crashData)
+    pd.testing.assert_frame_equal(pd.read_sql_table('crashData2018', location), crashData)
+
+
+@pytest.mark.parametrize('fused', [True, False])
+def test_transform_with_worker_processes(tmp_path, fused):
+    # Transform the same dummy sources sequentially and in worker processes
+    sequential_location = f"sqlite:///{tmp_path / 'sequential.sqlite'}"
+    parallel_location = f"sqlite:///{tmp_path / 'parallel.sqlite'}"
+    write_raw_database(sequential_location)
+    write_raw_database(parallel_location)
+    etl.transform(sequential_location, fused=fused)
+    etl.transform(parallel_location, fused=fused, workers=2)
+
+    # Check if the per-year outputs are identical
+    assert_tables_equal(sequential_location, parallel_location,
+                        ['crashDataNearby2017', 'crashDataNearby2018', 'crashDataNearby2019', 'crashData'])
+
+
+def test_transform_reruns_only_invalidated_nodes(tmp_path):
+    # Transform dummy sources and run it again without any change
+    location = f"sqlite:///{tmp_path / 'incremental.sqlite'}"
+    write_raw_database(location)
+    assert 'weatherCrashDataNormalized' in etl.transform(location), "Initial run skipped a node."
+    assert etl.transform(location) == [], "Unchanged pipeline was recomputed."
+
+    # Change one crash year and drop one filtered table
+    conn = sqlite3.connect(str(tmp_path / 'incremental.sqlite'))
+    conn.execute("UPDATE crashData2018 SET STRZUSTAND = 1 WHERE rowid <= 500")
+    conn.execute("DROP TABLE crashDataSnow")
+    conn.commit()
+    conn.close()
+
+    # Check if only the invalidated nodes and their descendants ran
+    ran = etl.transform(location)
+    assert sorted(ran) == sorted(['crashDataNearby2018', 'crashData', 'crashDataWet', 'crashDataSnow', 'crashDataWetSnow',
+                                  'crashCounts', 'weatherCrashData', 'weatherCrashDataNormalized', 'weatherCrashDataLOD']), "Wrong nodes were recomputed."
+
+
+@pytest.mark.parametrize('year', [2017, 2018, 2019])
+def test_preprocess_crash_data_pushdown(tmp_path, year):
+    location = f"sqlite:///{tmp_path / 'pushdown.sqlite'}"
+    write_raw_database(location)
+
+    # Check if the SQL filters return the same crashes as the pandas filters
+    expected = etl.preprocess_crash_data('crashData' + str(year), year, location)
+    result = etl.preprocess_crash_data('crashData' + str(year), year, location, pushdown=True)
+    pd.testing.assert_frame_equal(result, expected.reset_index(drop=True))
+
+
+def test_combine_weather_and_crash_data_single_pass(tmp_path):
+    location = f"sqlite:///{tmp_path / 'single_pass.sqlite'}"
+    write_raw_database(location)
+    etl.transform(location, single_pass=False)
+
+    # Check if one groupby over crashData gives the same counts as the four merges
+    expected = etl.combine_weather_and_crash_data(location)
+    result = etl.combine_weather_and_crash_data(location, single_pass=True)
+    pd.testing.assert_frame_equal(result, expected)
+
+    # Without materializing the filtered tables the result stays the same
+    other_location = f"sqlite:///{tmp_path / 'not_materialized.sqlite'}"
+    write_raw_database(other_location)
+    etl.transform(other_location, materialize_filtered=False)
+    assert not etl.table_exists('crashDataWet', other_location), "Filtered table was materialized."
+    assert_tables_equal(location, other_location, ['weatherCrashData', 'weatherCrashDataNormalized'])
+
+
+def test_normalize_per_route_vectorized(tmp_path):
+    # Write a weatherCrashData table with many routes of different lengths, including single rows
+    location = f"sqlite:///{tmp_path / 'normalize.sqlite'}"
+    rng = np.random.default_rng(3)
+    weatherCrashData = pd.DataFrame({'Strecke': rng.integers(0, 500, 5000).astype(str)})
+    for column in ['Nebel', 'Black Ice', 'Neuschnee', 'Gesamtschnee', 'Niederschlag', 'Wind', 'Windböen', 'Gesamt',
+                   'NormalizedCrash', 'NormalizedCrashWet', 'NormalizedCrashSnow', 'NormalizedCrashWetSnow']:
+        weatherCrashData[column] = rng.uniform(0, 100, len(weatherCrashData)).round(1)
+    # A constant column turns into NaN values
+    weatherCrashData.loc[weatherCrashData['Strecke'] == '7', 'NormalizedCrashWet'] = 0.0
+    weatherCrashData.to_sql('weatherCrashData', location, index=False)
+
+    # Check if the vectorized method gives bit for bit the same values as groupby.apply
+    expected = etl.normalize_per_Route(location, method='groupby').reset_index(drop=True)
+    result = etl.normalize_per_Route(location).reset_index(drop=True)
+    pd.testing.assert_frame_equal(result, expected, check_exact=True)
+
+
+def test_incomplete_table_storage_fails_on_creation(tmp_path):
+    class CsvStorage(etl.TableStorage):
+        extension = '.csv'
+
+        def write_table(self, table, path):
+            table.to_pandas().to_csv(path, index=False)
+
+    with pytest.raises(TypeError):
+        CsvStorage(str(tmp_path / 'csv'))
+
+
+@pytest.mark.parametrize('storage', ['parquet', 'arrow'])
+def test_transform_with_columnar_storage(tmp_path, storage):
+    pytest.importorskip('pyarrow')
+    location = f"sqlite:///{tmp_path / 'sqlite.sqlite'}"
+    other_location = f"sqlite:///{tmp_path / 'columnar.sqlite'}"
+    write_raw_database(location)
+    write_raw_database(other_location)
+    etl.transform(location)
+
+    # Check if the intermediate tables are files and the published tables are the same
+    with etl.PipelineContext(storage=storage):
+        etl.transform(other_location)
+        assert os.path.exists(tmp_path / f'columnar_{storage}' / f'crashData.{storage}'), "Intermediate table not stored as file."
+        assert etl.transform(other_location) == [], "Unchanged pipeline was recomputed."
+        for table in ['weatherCrashData', 'weatherCrashDataNormalized']:
+            etl.store_transformed_data_in_own_database(table, other_location, f"sqlite:///{tmp_path / 'app.sqlite'}")
+    assert_tables_equal(location, f"sqlite:///{tmp_path / 'app.sqlite'}", ['weatherCrashData', 'weatherCrashDataNormalized'])
+
+    # Compare the backends on one of the tables
+    comparison = etl.compare_storage_backends(['weatherDataID'], location)
+    assert sorted(comparison['storage']) == ['arrow', 'parquet', 'sqlite'], "Storage backend missing in comparison."
+    assert (comparison['size_bytes'] > 0).all(), "Table size not measured."
+
+
+def test_lean_dtypes(tmp_path, caplog):
+    location = f"sqlite:///{tmp_path / 'lean.sqlite'}"
+    other_location = f"sqlite:///{tmp_path / 'not_lean.sqlite'}"
+    write_raw_database(location)
+    write_raw_database(other_location)
+
+    # Check if the lean crash table is smaller and restores to the same values and dtypes
+    crashData = etl.read_table_from_sqlite('crashData2018', location)
+    lean = etl.optimize_dtypes('crashData2018', crashData)
+    assert lean.memory_usage(deep=True).sum() < crashData.memory_usage(deep=True).sum() / 2, "Lean dtypes do not save memory."
+    assert lean['IstRad'].dtype == bool and lean['UREGBEZ'].dtype == 'category', "Declared dtypes not applied."
+    pd.testing.assert_frame_equal(etl.restore_dtypes(lean), crashData)
+    assert crashData['IstRad'].dtype == 'int64', "Original frame was changed."
+    assert np.shares_memory(lean['XGCSWGS84'].to_numpy(), crashData['XGCSWGS84'].to_numpy()), "Unconverted column was copied."
+
+    # The transform gives the same tables with lean dtypes
+    etl.transform(location, lean_dtypes=True)
+    etl.transform(other_location)
+    assert_tables_equal(location, other_location, ['crashDataNearby2017', 'crashData', 'crashDataWetSnow', 'weatherCrashDataNormalized'])
+
+    # A chunked transform reports the lean dtypes of every table once, not per chunk
+    chunked_location = f"sqlite:///{tmp_path / 'lean_chunked.sqlite'}"
+    write_raw_database(chunked_location)
+    with caplog.at_level('INFO', logger=etl.__name__):
+        etl.transform(chunked_location, lean_dtypes=True, chunksize=300)
+    reports = [record.getMessage().split(':')[0] for record in caplog.records if record.getMessage().startswith('Lean dtypes')]
+    assert 'Lean dtypes of crashData2019' in reports and len(reports) == len(set(reports)), "Lean dtypes not reported once per table."
+
+
+def test_transform_out_of_core(tmp_path):
+    location = f"sqlite:///{tmp_path / 'in_memory.sqlite'}"
+    chunked_location = f"sqlite:///{tmp_path / 'chunked.sqlite'}"
+    for database in ['in_memory.sqlite', 'chunked.sqlite']:
+        write_raw_database(f"sqlite:///{tmp_path / database}")
+        # Add a further year with the layout of 2019
+        conn = sqlite3.connect(str(tmp_path / database))
+        conn.execute(conn.execute("SELECT sql FROM sqlite_master WHERE name = 'crashData2019'").fetchone()[0].replace('crashData2019', 'crashData2020'))
+        conn.execute("INSERT INTO crashData2020 SELECT * FROM crashData2019")
+        conn.commit()
+        conn.close()
+
+    # Check if streaming small chunks through the stages gives the same tables
+    years = [2017, 2018, 2019, 2020]
+    etl.transform(location, years=years)
+    etl.transform(chunked_location, years=years, chunksize=300)
+    assert_tables_equal(location, chunked_location, ['crashDataNearby2017', 'crashDataNearby2020', 'crashData', 'crashDataWet',
+                                                     'crashDataSnow', 'crashDataWetSnow', 'crashCounts', 'weatherCrashData',
+                                                     'weatherCrashDataNormalized'])
+    conn = sqlite3.connect(str(tmp_path / 'in_memory.sqlite'))
+    chunked_conn = sqlite3.connect(str(tmp_path / 'chunked.sqlite'))
+    assert conn.execute("PRAGMA table_info(crashData);").fetchall() == chunked_conn.execute("PRAGMA table_info(crashData);").fetchall()
+    conn.close()
+    chunked_conn.close()
+
+
+@pytest.mark.parametrize('storage', ['parquet', 'arrow'])
+def test_transform_out_of_core_with_columnar_storage(tmp_path, storage):
+    pytest.importorskip('pyarrow')
+    location = f"sqlite:///{tmp_path / 'sqlite.sqlite'}"
+    other_location = f"sqlite:///{tmp_path / 'columnar.sqlite'}"
+    write_raw_database(location)
+    write_raw_database(other_location)
+    etl.transform(location)
+
+    # Stream the chunks into the files and check if the tables are the same
+    with etl.PipelineContext(storage=storage):
+        etl.transform(other_location, chunksize=300)
+        assert etl.table_column_types('crashData', other_location)['Strecke'] == 'TEXT', "Schema not read from the file."
+        chunks = list(etl.read_table_chunks('crashData', other_location, 300))
+        assert len(chunks) > 1 and all(len(chunk) <= 300 for chunk in chunks), "Table not read in chunks."
+        crashData = pd.concat(chunks, ignore_index=True)
+        assert etl.transform(other_location, chunksize=300) == [], "Unchanged pipeline was recomputed."
+        for table in ['weatherCrashData', 'weatherCrashDataNormalized']:
+            etl.store_transformed_data_in_own_database(table, other_location, f"sqlite:///{tmp_path / 'app.sqlite'}")
+    pd.testing.assert_frame_equal(crashData, pd.read_sql_table('crashData', location))
+    assert_tables_equal(location, f"sqlite:///{tmp_path / 'app.sqlite'}", ['weatherCrashData', 'weatherCrashDataNormalized'])
+
+
+def test_ingest_year(tmp_path):
+    incremental_location = f"sqlite:///{tmp_path / 'incremental.sqlite'}"
+    location = f"sqlite:///{tmp_path / 'full.sqlite'}"
+    for database in ['incremental.sqlite', 'full.sqlite', 'default.sqlite']:
+        write_raw_database(f"sqlite:///{tmp_path / database}")
+        # Add a further year with the layout of 2019 and other road conditions
+        conn = sqlite3.connect(str(tmp_path / database))
+        conn.execute(conn.execute("SELECT sql FROM sqlite_master WHERE name = 'crashData2019'").fetchone()[0].replace('crashData2019', 'crashData2020'))
+        conn.execute("INSERT INTO crashData2020 SELECT * FROM crashData2019")
+        conn.execute("UPDATE crashData2020 SET UJAHR = 2020, STRZUSTAND = (rowid % 3)")
+        conn.commit()
+        conn.close()
+
+    # Ingest the new year into the transformed earlier years and transform all years at once
+    etl.transform(incremental_location)
+    assert etl.ingested_years(incremental_location) == [2017, 2018, 2019], "Aggregates miss a year."
+    etl.ingest_year(2020, incremental_location)
+    etl.transform(location, years=[2017, 2018, 2019, 2020])
+
+    # Check if the segment counts and the tables of the app are the same
+    assert etl.ingested_years(incremental_location) == [2017, 2018, 2019, 2020], "Year not ingested."
+    tables = ['crashDataNearby2020', 'crashCounts', 'weatherCrashData', 'weatherCrashDataNormalized', 'weatherCrashDataLOD']
+    assert_tables_equal(location, incremental_location, tables)
+
+    # Ingesting the year again does not count its crashes twice
+    etl.ingest_year(2020, incremental_location)
+    assert_tables_equal(location, incremental_location, tables)
+
+    # A later full transform with the new year reuses its joined crashes
+    assert 'crashDataNearby2020' not in etl.transform(incremental_location, years=[2017, 2018, 2019, 2020]), "Ingested year joined again."
+    assert_tables_equal(location, incremental_location, tables + ['crashData'])
+
+    # A transform of the default years after an ingest counts only the crashes in crashData again
+    default_location = f"sqlite:///{tmp_path / 'default.sqlite'}"
+    reference_location = f"sqlite:///{tmp_path / 'reference.sqlite'}"
+    write_raw_database(reference_location)
+    etl.transform(reference_location)
+    etl.transform(default_location)
+    etl.ingest_year(2020, default_location)
+    ran = etl.transform(default_location)
+    assert {'crashCounts', 'weatherCrashData'} <= set(ran) and 'crashData' not in ran, "Ingested counts were kept."
+    assert_tables_equal(reference_location, default_location, ['crashData', 'crashCounts', 'weatherCrashData',
+                                                               'weatherCrashDataNormalized', 'weatherCrashDataLOD'])
+
+
+def test_pipeline_context_shares_pooled_connections(tmp_path):
+    location = f"sqlite:///{tmp_path / 'pooled.sqlite'}"
+    write_raw_database(location)
+
+    with etl.PipelineContext(pool_size=5, max_overflow=0) as context:
+        # Repeated checks reuse the same pooled connection
+        for _ in range(50):
+            assert etl.table_exists('weatherData', location), "Table not found."
+        assert context.connections_opened == 1, "Table checks opened new connections."
+
+        # The whole transform never opens more connections than the pool holds
+        etl.transform(location)
+        assert context.connections_opened <= 5, "Transform opened more connections than the pool size."
+        assert etl.get_engine(location) is etl.get_engine(location), "Engine is not shared."
+
+    assert etl.pipeline_context is not context, "Context is still active."
+
+
+def test_benchmark_writes_results(tmp_path):
+    output = tmp_path / 'benchmark.json'
+    results = benchmark.run_benchmarks([600], str(output), routes=3, points_per_route=40)
+
+    # Every stage is measured with times, memory and row counts
+    assert output.exists(), "Benchmark results not written."
+    stages = {record['stage'] for record in results['results']}
+    assert stages == {'preprocess_crash_data', 'connect_crash_data_with_weather_data', 'assign_crash_to_weather_data',
+                      'combine_weather_and_crash_data', 'normalize_per_Route'}, "Stages are missing."
+    for record in results['results']:
+        assert record['wall_seconds'] >= 0 and record['peak_memory_bytes'] > 0, "Stage not measured."
+        assert record['rows_out'] <= record['rows_in'] or record['stage'] == 'combine_weather_and_crash_data', "Rows not counted."
+    preprocessed = [record for record in results['results'] if record['stage'] == 'preprocess_crash_data']
+    rows_out = {(record['parameters']['year'], record['parameters']['pushdown']): record['rows_out'] for record in preprocessed}
+    assert all(rows_out[year, True] == rows_out[year, False] for year, _ in rows_out), "Pushdown rows differ."
+
+    # A run compared with itself has no regressions
+    comparison = benchmark.compare_results(results, results)
+    assert (comparison['wall_ratio'] == 1).all(), "Comparison of identical runs differs."
+
+
+def test_transform_records_pipeline_runs(tmp_path, caplog):
+    location = f"sqlite:///{tmp_path / 'runs.sqlite'}"
+    write_raw_database(location)
+
+    with caplog.at_level('INFO', logger=etl.__name__):
+        etl.transform(location)
+    report = etl.pipeline_run_report(location=location)
+
+    # One row per node below the transform stage, all of the same run
+    assert report['run_id'].nunique() == 1, "Stages of one run have different run ids."
+    transform = report.set_index('stage').loc['transform']
+    nodes = report[report['parent'] == 'transform']
+    assert len(nodes) == 12 and (nodes['status'] == 'ok').all(), "Not every node is recorded."
+    assert (report[['wall_seconds', 'cpu_seconds', 'peak_memory_bytes']] > 0).all().all(), "Stage not measured."
+    assert transform['rows_out'] == nodes['rows_out'].sum(), "Nested writes are not counted in the transform stage."
+    normalized = nodes.set_index('stage').loc['weatherCrashDataNormalized']
+    assert normalized['rows_in'] == normalized['rows_out'] == 300, "Rows of the normalization are wrong."
+    assert normalized['bytes_written'] > 0, "Written bytes are not counted."
+    assert len(caplog.records) == 13, "Stages are not logged."
+    assert json.loads(caplog.records[-1].getMessage())['stage'] == 'transform', "Log is not structured."
+
+    # An unchanged rerun skips every node and starts a new run
+    etl.transform(location)
+    rerun = etl.pipeline_run_report(location=location)
+    assert rerun['run_id'].iloc[0] != report['run_id'].iloc[0], "Rerun has the same run id."
+    assert (rerun[rerun['parent'] == 'transform']['status'] == 'skipped').all(), "Unchanged nodes are not skipped."
+
+
+def test_app_data_is_cached_until_the_database_changes(tmp_path):
+    path = str(tmp_path / 'app.sqlite')
+    weatherCrashData = pd.DataFrame({'Strecke': ['B', 'A', 'B', 'C', 'A'], 'Kilometer': [1, 1, 2, 1, 2], 'NormalizedCrash': np.arange(5.0)})
+    weatherCrashData.to_sql('weatherCrashDataNormalized', f"sqlite:///{path}", index=False)
+    version = etl.stamp_data_version(f"sqlite:///{path}")
+
+    # Repeated loads return the same data and every route slice matches a filter of the table
+    data = load_app_data('weatherCrashDataNormalized', path)
+    assert load_app_data('weatherCrashDataNormalized', path) is data, "Data is loaded twice."
+    assert data.version == version, "Version stamp not read."
+    assert data.routes == ['B', 'A', 'C'], "Route order changed."
+    for route in data.routes:
+        pd.testing.assert_frame_equal(data.route(route).reset_index(drop=True),
+                                      weatherCrashData[weatherCrashData['Strecke'] == route].reset_index(drop=True))
+    assert data.route('D').empty, "Unknown route returned rows."
+
+    # A new stamp of the pipeline changes the database and invalidates the cache
+    os.utime(path, ns=(0, 0))
+    new_version = etl.stamp_data_version(f"sqlite:///{path}")
+    reloaded = load_app_data('weatherCrashDataNormalized', path)
+    assert reloaded is not data and reloaded.version == new_version, "Cache not invalidated."
+
+
+def test_levels_of_detail(tmp_path):
+    location = f"sqlite:///{tmp_path / 'lod.sqlite'}"
+    write_raw_database(location)
+    etl.transform(location)
+    normalized = pd.read_sql_table('weatherCrashDataNormalized', location)
+    levels = pd.read_sql_table('weatherCrashDataLOD', location)
+
+    # Every level covers every route point once, the finest level is the points themselves
+    assert sorted(levels['Level'].unique()) == etl.LOD_BUCKET_SIZES, "Levels are missing."
+    assert (levels.groupby('Level')['Points'].sum() == len(normalized)).all(), "Levels lost route points."
+    finest = levels[levels['Level'] == 1].reset_index(drop=True)
+    pd.testing.assert_series_equal(finest['NormalizedCrash'], normalized['NormalizedCrash'])
+    pd.testing.assert_series_equal(finest['Latitude'], normalized['Latitude'])
+
+    # A coarse bucket carries the mean of its points
+    bucket = normalized[(normalized['Strecke'] == 'A') & (normalized['Kilometer'] <= 25)]
+    coarse = levels[(levels['Level'] == 25) & (levels['Strecke'] == 'A')].iloc[0]
+    assert coarse['Points'] == 25 and coarse['Kilometer'] == 1, "Bucket has the wrong points."
+    assert np.isclose(coarse['NormalizedCrash'], bucket['NormalizedCrash'].mean()), "Bucket mean is wrong."
+    assert np.isclose(coarse['Longitude'], bucket['Longitude'].mean()), "Bucket position is wrong."
+
+    # The app shows coarser levels at lower zooms
+    assert [level_for_zoom(zoom) for zoom in (4.5, 7, 10)] == [25, 5, 1], "Wrong level for the zoom."
+
+
+def test_read_connection_pool_wakes_waiters_after_reset(tmp_path):
+    sqlite3.connect(str(tmp_path / 'app.sqlite')).close()
+    pool = ReadConnectionPool(str(tmp_path / 'app.sqlite'), size=2, timeout=5)
+    connections = [pool.acquire(), pool.acquire()]
+
+    # A request waits for the full pool, the stale connections of a reset make room for it
+    pool.reset()
+    result = {}
+    waiter = threading.Thread(target=lambda: result.update(connection=pool.acquire()))
+    waiter.start()
+    for generation, conn in connections:
+        pool.release(generation, conn)
+    waiter.join(timeout=2)
+    assert not waiter.is_alive() and 'connection' in result, "Waiting request was not woken."
+    assert result['connection'][0] == pool.generation and pool.created == 1, "Stale connection was reused."
+    pool.release(*result['connection'])
+
+
+def test_query_service(tmp_path):
+    location = f"sqlite:///{tmp_path / 'data.sqlite'}"
+    app_location = f"sqlite:///{tmp_path / 'app.sqlite'}"
+    write_raw_database(location)
+    etl.transform(location)
+    for table in ['weatherCrashData', 'weatherCrashDataNormalized']:
+        etl.store_transformed_data_in_own_database(table, location, app_location)
+    etl.stamp_data_version(app_location)
+    normalized = pd.read_sql_table('weatherCrashDataNormalized', app_location)
+
+    server = create_query_server(str(tmp_path / 'app.sqlite'), port=0, pool_size=4)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    def query(path, **headers):
+        response = requests.get(url + path, headers=headers)
+        if response.status_code != 200:
+            return response, None
+        body = response.json()
+        return response, pd.DataFrame(body['rows'], columns=body['columns'])
+
+    try:
+        # Route, segment and bounding box queries return the rows of the table
+        response, rows = query('/weatherCrashDataNormalized/strecke/B')
+        expected = normalized[normalized['Strecke'] == 'B'].reset_index(drop=True)
+        pd.testing.assert_frame_equal(rows, expected, check_dtype=False)
+        _, rows = query('/weatherCrashData/streckeid/A_7')
+        assert list(rows['StreckeID']) == ['A_7'], "Segment query is wrong."
+        _, rows = query('/weatherCrashDataNormalized/bbox?min_lat=48.1&max_lat=48.3&min_lon=9&max_lon=10')
+        inside = normalized['Latitude'].between(48.1, 48.3) & normalized['Longitude'].between(9, 10)
+        assert len(rows) == inside.sum() > 0, "Bounding box query is wrong."
+
+        # Unchanged data answers the ETag with 304, a new publish changes the ETag
+        etag = response.headers['ETag']
+        assert query('/weatherCrashDataNormalized/strecke/B', **{'If-None-Match': etag})[0].status_code == 304, "ETag not honored."
+        etl.stamp_data_version(app_location)
+        response, _ = query('/weatherCrashDataNormalized/strecke/B', **{'If-None-Match': etag})
+        assert response.status_code == 200 and response.headers['ETag'] != etag, "ETag not tied to the data version."
+
+        # Unknown tables and invalid parameters are rejected
+        assert query('/crashData/strecke/B')[0].status_code == 404, "Unknown table was queried."
+        assert query('/weatherCrashData/bbox?min_lat=x')[0].status_code == 400, "Invalid bbox was queried."
+
+        # Parallel clients share the pooled connections
+        paths = [f'/weatherCrashData/streckeid/{route}_{kilometer}' for route in 'ABC' for kilometer in range(1, 31)]
+        with ThreadPoolExecutor(16) as executor:
+            results = list(executor.map(query, paths))
+        assert all(len(rows) == 1 for _, rows in results), "Parallel queries failed."
+        assert server.service.pool.created <= 4, "More connections than the pool size."
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_publish_app_database(tmp_path):
+    location = f"sqlite:///{tmp_path / 'data.sqlite'}"
+    plain_location = f"sqlite:///{tmp_path / 'plain.sqlite'}"
+    app_location = f"sqlite:///{tmp_path / 'app.sqlite'}"
+    write_raw_database(location)
+    etl.transform(location)
+    for table in etl.PUBLISHED_TABLES:
+        etl.store_transformed_data_in_own_database(table, location, plain_location, indexed=False)
+    version = etl.publish_app_database(location, app_location)
+
+    # The published tables hold the same data as the plain copies
+    assert_tables_equal(plain_location, app_location, etl.PUBLISHED_TABLES)
+    conn = sqlite3.connect(str(tmp_path / 'app.sqlite'))
+    assert conn.execute('SELECT version FROM data_version').fetchone()[0] == version, "Data version not stamped."
+
+    # Keys are declared and the route, segment and coordinate queries use indexes
+    columns = conn.execute('PRAGMA table_info(weatherCrashData)').fetchall()
+    assert [column[1] for column in columns if column[5]] == ['StreckeID'], "Key not declared."
+    for query in ['SELECT * FROM weatherCrashData WHERE Strecke = ?',
+                  'SELECT * FROM weatherCrashDataNormalized WHERE StreckeID = ?',
+                  'SELECT * FROM weatherCrashDataNormalized WHERE Latitude BETWEEN ? AND ?']:
+        plan = ' '.join(row[-1] for row in conn.execute('EXPLAIN QUERY PLAN ' + query, (1,) * query.count('?')))
+        assert 'USING INDEX' in plan, f"Query does not use an index: {plan}"
+    assert conn.execute('SELECT COUNT(*) FROM sqlite_stat1').fetchone()[0] > 0, "Tables not analyzed."
+    if etl.rtree_available(conn):
+        assert conn.execute('SELECT COUNT(*) FROM weatherCrashData_rtree').fetchone()[0] == 300, "Spatial index incomplete."
+
+    # The route summary holds the totals of every route
+    summary = pd.read_sql_query('SELECT * FROM weatherCrashDataRouteSummary ORDER BY Strecke', conn)
+    weatherCrashData = pd.read_sql_table('weatherCrashData', app_location)
+    expected = weatherCrashData.groupby('Strecke')[['CrashCount', 'CrashCountWet']].sum()
+    assert summary['Segments'].tolist() == [100, 100, 100], "Segments per route are wrong."
+    assert np.allclose(summary[['CrashCount', 'CrashCountWet']].fillna(0), expected.to_numpy()), "Crash totals are wrong."
+
+    # A publish that fails on the key keeps the previous table and its spatial index
+    source = sqlite3.connect(str(tmp_path / 'data.sqlite'))
+    broken = sqlite3.connect(str(tmp_path / 'broken.sqlite'))
+    source.backup(broken)
+    broken.execute("UPDATE weatherCrashData SET StreckeID = 'A_1' WHERE StreckeID = 'A_2'")
+    broken.commit()
+    source.close()
+    broken.close()
+    with pytest.raises(sqlite3.IntegrityError):
+        etl.store_transformed_data_in_own_database('weatherCrashData', f"sqlite:///{tmp_path / 'broken.sqlite'}", app_location)
+    pd.testing.assert_frame_equal(pd.read_sql_table('weatherCrashData', app_location), weatherCrashData)
+    if etl.rtree_available(conn):
+        assert conn.execute('SELECT COUNT(*) FROM weatherCrashData_rtree').fetchone()[0] == 300, "Spatial index was dropped."
+    conn.close()
+
+    # The latency benchmark measures every query before and after publishing
+    records = benchmark.benchmark_app_queries(location, str(tmp_path), repeats=2)
+    assert {(record['parameters']['query'], record['parameters']['indexed']) for record in records} == \
+        {(query, indexed) for query in ['strecke', 'streckeid', 'bbox', 'lod', 'route_summary'] for indexed in (False, True)}
+
+
+def test_bulk_load_matches_to_sql(tmp_path):
+    # Define dummy data with integers, floats, text and missing values
+    data = pd.DataFrame({
+        'ULAND': np.arange(1000),
+        'Latitude': np.linspace(48, 49, 1000),
+        'Strecke': ['A', None] * 500,
+        'LICHT': np.where(np.arange(1000) % 3 == 0, np.nan, 1.0),
+        'IstGkfz': np.arange(1000) % 2 == 0
+    })
+    location = f"sqlite:///{tmp_path / 'to_sql.sqlite'}"
+    bulk_location = f"sqlite:///{tmp_path / 'bulk.sqlite'}"
+
+    # Load the data once with to_sql and once in small bulk batches
+    etl.load('data', data, location)
+    rows_per_second = etl.bulk_load('data', data, bulk_location, batch_size=64)
+    etl.bulk_load('data', data, bulk_location, if_exists='append')
+
+    # Check if the schema and the rows are the same
+    conn = sqlite3.connect(str(tmp_path / 'to_sql.sqlite'))
+    bulk_conn = sqlite3.connect(str(tmp_path / 'bulk.sqlite'))
+    assert conn.execute("PRAGMA table_info(data);").fetchall() == bulk_conn.execute("PRAGMA table_info(data);").fetchall()
+    assert bulk_conn.execute("PRAGMA journal_mode;").fetchone()[0] == 'wal', "WAL mode not enabled."
+    conn.close()
+    bulk_conn.close()
+    bulk_data = pd.read_sql_table('data', bulk_location)
+    pd.testing.assert_frame_equal(bulk_data.iloc[:1000], pd.read_sql_table('data', location))
+    assert len(bulk_data) == 2000, "Appended rows missing."
+    assert rows_per_second > 0
+
+
+def test_failed_bulk_load_keeps_previous_table(tmp_path, caplog):
+    location = f"sqlite:///{tmp_path / 'bulk.sqlite'}"
+    etl.bulk_load('t', pd.DataFrame({'a': [1, 2, 3]}), location)
+
+    # A row that sqlite3 cannot bind fails the replacing load after its first batch
+    with pytest.raises(sqlite3.Error):
+        etl.bulk_load('t', pd.DataFrame({'a': [4, {}]}, dtype=object), location, batch_size=1)
+    pd.testing.assert_frame_equal(pd.read_sql_table('t', location), pd.DataFrame({'a': [1, 2, 3]}))
+
+    # A chunked bulk load reports its rate once for the table
+    chunks = (pd.DataFrame({'a': range(start, start + 10)}) for start in range(0, 100, 10))
+    with caplog.at_level('INFO', logger=etl.__name__):
+        assert etl.load_chunks('t', chunks, location, bulk=True) == 100
+    assert [record.getMessage().split(' (')[0] for record in caplog.records] == ['Loaded 100 rows into t'], "Rate not reported once."
+
+
 def test_weatherdata_columns():
     # Connect to the SQLite database
     conn = sqlite3.connect('project/test/test_data.sqlite')  